@@ -5,11 +5,16 @@ from pypsa.descriptors import get_extendable_i
 import pandas as pd
 import sys
 import os
+import threading
 import warnings
 import logging
 from pypsa.linopt import get_sol
 from .solutions import Solution
-from ..utilities.solve_network import solve_network
+from ..utilities.solve_network import (solve_network,
+                                       resolve_variables,
+                                       PersistentModel,
+                                       get_persistent_model)
+from ..utilities.time_aggregation import aggregate_network
 warnings.simplefilter("ignore")
 logging.basicConfig(level=logging.ERROR)
 
@@ -31,6 +36,16 @@ def setup_applevel_logger(logger_name, file_name=None):
 
 logger = setup_applevel_logger('TestCase')
 
+# Worker-local cache of the prepared network and its resolved variables, 
+# so the network file is only parsed once per worker process. The cache is
+# kept per thread, as threads of a ThreadExecutor must not share a network
+_local = threading.local()
+
+def _network_cache():
+    if not hasattr(_local, 'networks'):
+        _local.networks = {}
+    return _local.networks
+
 
 class PyPSA_to_case:
     '''
@@ -45,7 +60,19 @@ class PyPSA_to_case:
     - variables (dict, optional): Dictionary of variables used in the network.
     - tmp_network_path (str, optional): Path to store the temporary network file.
     - n_snapshots (int, optional): Number of snapshots to consider.
+    - aggregation (str, optional): Reduce the snapshots to n_snapshots by
+      'kmeans' or 'hierarchical' clustering of representative periods, or by
+      'segmentation' into contiguous segments. If None, the first 
+      n_snapshots are used.
+    - period_length (int, optional): Number of snapshots in a representative
+      period, e.g. 24 for days or 168 for weeks.
     - mga_slack (float, optional): Slack parameter for MGA algorithm.
+    - persistent_model (bool, optional): Build the near-optimal model once 
+      per worker and only replace the objective between directions. 
+      Requires the gurobi solver.
+    - warm_start (bool, optional): Re-optimize each direction with simplex 
+      from the basis of the nearest direction already solved on the worker.
+      Implies persistent_model.
     '''
     def __init__(self,
                  project_name,
@@ -55,7 +82,11 @@ class PyPSA_to_case:
                  variables=None,
                  tmp_network_path='tmp/networks/tmp.h5',
                  n_snapshots=8760,
-                 mga_slack=0.1):
+                 aggregation=None,
+                 period_length=24,
+                 mga_slack=0.1,
+                 persistent_model=False,
+                 warm_start=False):
         # Initialize case object by setting some attributes and writing the 
         # network to disk.
         
@@ -67,9 +98,13 @@ class PyPSA_to_case:
         self.config_path        = 'networks/config.yaml'
         self.config             = config
         self.extra_func         = extra_func
+        self.persistent_model   = persistent_model or warm_start
+        self.warm_start         = warm_start
 
         self.n_snapshots = n_snapshots
         self.start_point = 0
+        self.aggregation = aggregation
+        self.period_length = period_length
         self.mga_slack = mga_slack
         self.objective_optimum = None
 
@@ -82,10 +117,16 @@ class PyPSA_to_case:
         n = pypsa.Network(self.base_network_path)
         
         # Adjust snapshot amount and weighting
-        n.snapshots = n.snapshots[self.start_point:self.start_point + self.n_snapshots]
-        n.snapshot_weightings = n.snapshot_weightings[self.start_point:self.start_point+self.n_snapshots]
-        # n.snapshot_weightings = (n.snapshot_weightings*0 + int(8760/200)).astype(int)
-        n.snapshot_weightings = (n.snapshot_weightings*0 + int(8760/self.n_snapshots)).astype(int)
+        if self.aggregation is not None:
+            aggregate_network(n,
+                              self.n_snapshots,
+                              method=self.aggregation,
+                              period_length=self.period_length)
+        else:
+            n.snapshots = n.snapshots[self.start_point:self.start_point + self.n_snapshots]
+            n.snapshot_weightings = n.snapshot_weightings[self.start_point:self.start_point+self.n_snapshots]
+            # n.snapshot_weightings = (n.snapshot_weightings*0 + int(8760/200)).astype(int)
+            n.snapshot_weightings = (n.snapshot_weightings*0 + int(8760/self.n_snapshots)).astype(int)
 
         # Write network to file ---------------------
         p = os.path.dirname(self.network_path)
@@ -99,12 +140,53 @@ class PyPSA_to_case:
             print('Error', e)
             pass
 
+        # Networks cached from the previous file are no longer valid
+        _network_cache().clear()
+
+    def network_key(self):
+        # Identifies the prepared network. Changes when the network file is
+        # rewritten or the snapshots or slack of the case are changed.
+        stat = os.stat(self.network_path)
+        return (os.path.abspath(self.network_path),
+                stat.st_mtime_ns,
+                stat.st_size,
+                self.n_snapshots,
+                self.start_point,
+                self.aggregation,
+                self.period_length,
+                self.mga_slack)
+
+    def load_network(self):
+        # The cached network and the positions of the components of each 
+        # variable in it
+        key = (self.network_key(), repr(self.variables))
+        cache = _network_cache()
+        if key not in cache:
+            cache.clear()
+
+            # Create new network
+            n = pypsa.Network()
+            
+            # Import network
+            n.import_from_hdf5(self.network_path)
+
+            cache[key] = (n, resolve_variables(n, self.variables))
+
+        return cache[key]
+
+    def variable_index(self, variables=None):
+        '''
+        The variables resolved into component positions of the network,
+        see resolve_variable. 
+        '''
+        if variables is None:
+            variables = list(self.variables.keys())
+        index = self.load_network()[1]
+        return [index[v] for v in variables]
+
     def read_network(self):
-        # Create new network
-        n = pypsa.Network()
-        
-        # Import network
-        n.import_from_hdf5(self.network_path)
+        # Hand out a copy, as solving modifies the network
+        n = self.load_network()[0].copy()
         
         # Set optimum objective value
         n.objective_optimum = self.objective_optimum
@@ -138,7 +220,13 @@ class PyPSA_to_case:
             variables = list(self.variables.keys())
             
         options = dict(mga_slack=self.mga_slack,
-                       mga_variables=[self.variables[v] for v in variables])
+                       mga_variables=[self.variables[v] for v in variables],
+                       mga_index=self.variable_index(variables))
+
+        if self.persistent_model:
+            return self.search_direction_persistent(direction, 
+                                                    variables, 
+                                                    options)
 
         n = self.read_network()
         n, status = solve_network(n,
@@ -148,14 +236,11 @@ class PyPSA_to_case:
                                   extra_func = self.extra_func,
                                   solver_log='logs/log.log')
 
-        mga_variables = options['mga_variables']
         var_values = []
-        for var_i in mga_variables:
-            mask = n.df(var_i[0]).carrier.isin(var_i[1])
-            if len(var_i) > 3: 
-                mask = mask & n.df(var_i[0]).country.isin(var_i[3])
-
-            var_values.append(get_sol(n, var_i[0], var_i[2])[mask].sum())
+        for index_i in options['mga_index']:
+            # The solution is given for all components of the network
+            sol = get_sol(n, index_i['component'], index_i['attr'])
+            var_values.append(sol.values[index_i['pos']].sum())
 
         if status == 'ok':
             all_variable_values = self.get_var_values(n)
@@ -171,12 +256,53 @@ class PyPSA_to_case:
                 n.objective,
                 var_values)
 
+    def build_persistent_model(self, options):
+        # Build the near-optimal model of the case for the given options
+        n = self.read_network()
+        return PersistentModel(n,
+                               extra_func = self.extra_func,
+                               config=self.config['solving'],
+                               mga_options=options,
+                               variables=self.variables,
+                               warm_start=self.warm_start)
+
+    def search_direction_persistent(self, direction, variables, options):
+        # The model is rebuilt only if the network, the slack, the optimum
+        # or the variables have changed since it was last built on the worker
+        key = (self.network_path,
+               self.n_snapshots,
+               self.start_point,
+               self.aggregation,
+               self.period_length,
+               self.mga_slack,
+               self.objective_optimum,
+               self.warm_start,
+               tuple(variables))
+        model = get_persistent_model(key,
+                                     lambda: self.build_persistent_model(options))
+
+        status, objective, all_variable_values = model.solve_direction(direction,
+                                                                       variables)
+
+        if status != 'ok':
+            logger.debug(f'solver status {status}')
+            all_variable_values = {k: np.NaN for k in self.variables.keys()}
+
+        spec_var_values = [all_variable_values.get(v) for v in variables]
+
+        return (spec_var_values,
+                all_variable_values,
+                status,
+                objective,
+                spec_var_values)
+
     def solve_point(self, point, variables=None):
         if variables is None:
             variables = list(self.variables.keys())
             
         options = dict(mga_slack=None,
-                       mga_variables=[self.variables[v] for v in variables])
+                       mga_variables=[self.variables[v] for v in variables],
+                       mga_index=self.variable_index(variables))
 
         n = self.read_network()
 
@@ -205,12 +331,13 @@ class PyPSA_to_case:
         if variables is None:
             variables = list(self.variables.keys())
 
+        index = self.load_network()[1]
+
         variable_values = {}
         for var_i in self.variables:
-            var_val = self.variables[var_i]
-            df = n.df(var_val[0]).query('carrier==@var_val[1]')
-            val = df.loc[:, '{}_opt'.format(var_val[2])].sum()
-            variable_values[var_i] = val
+            index_i = index[var_i]
+            values = n.df(index_i['component'])['{}_opt'.format(index_i['attr'])].values
+            variable_values[var_i] = values[index_i['pos']].sum()
 
 
         return variable_values  # variable_investment
@@ -1,18 +1,31 @@
 import os
+import itertools
 import numpy as np
 import time
-import pickle
 import pandas as pd
-from scipy.spatial import ConvexHull
-from ..utilities.general import solve_direcitons
-from ..utilities.dask_helpers import start_dask_cluster
+from ..utilities.general import (DirectionSampler,
+                                 DirectionStream,
+                                 ResultStore,
+                                 direction_key)
+from ..utilities.executors import use_executor
+from ..utilities.checkpoint import (checkpoint_path,
+                                    save_checkpoint,
+                                    load_checkpoint)
+from ..utilities.hull import (RebuiltHull,
+                              support_gaps,
+                              projected_volume,
+                              select_directions)
 
 
 class MAA:
-    def __init__(self, case):
+    def __init__(self, case, session=None):
         """
+        case: case object to search
+        session: Executor shared between searches, e.g. a DaskSession. 
+                 If None, an executor is started and closed for each search.
         """
         self.case = case
+        self.session = session
         self.dim = len(case.variables)
 
     def find_optimum(self):
@@ -34,104 +47,301 @@ class MAA:
                           n_workers=4, 
                           max_iter=20,
                           save_tmp_results = True,
+                          min_vertices = None,
+                          executor = None,
+                          selection = 'random',
+                          gap_tol = 1e-6,
+                          n_candidates = 200,
+                          convergence = None,
+                          tol = None,
+                          max_hull_dim = 8,
+                          n_probe = 100,
+                          max_pairs = 50,
+                          resume = None,
                           ):
+        """
+        Performs the MAA search of the near-optimal space.
+        New directions are the facet normals of the convex hull of the 
+        vertices found so far. Facet normals that have already been searched
+        are not searched again.
+        min_vertices: Number of solved directions needed before the hull is 
+                      updated and new facet directions are submitted. The 
+                      remaining directions keep solving in the background.
+                      If None, all submitted directions are awaited before 
+                      the hull is updated.
+        executor: Executor running the solves, or the name of the executor
+                  to start for this search: 'dask' (default), 'process', 
+                  'thread' or 'serial'. Defaults to the session of the method.
+        selection: How new directions are chosen among the facet normals.
+                   'random' (default) draws a random subset of the facet 
+                   normals. 'gap' searches the facets with the largest gap 
+                   between the hull and the outer bound given by the 
+                   searched directions first, and skips near-duplicate 
+                   directions and facets without gap. The gap of each 
+                   candidate costs an LP, which is solved on the executor.
+        gap_tol: Facets with a gap below gap_tol times the diameter of the 
+                 hull are not searched with selection='gap'.
+        n_candidates: Maximum number of candidate directions whose gap is 
+                      evaluated in each iteration with selection='gap'.
+        convergence: Convergence measure epsilon. 'volume' is the relative
+                     change of the exact hull volume. 'gap' is the largest
+                     gap between the hull and the outer bound over n_probe 
+                     random directions, relative to the hull diameter. 
+                     'projected' is the relative change of the summed areas
+                     of the projections onto up to max_pairs pairs of 
+                     variables. Defaults to 'volume' if the hull is used 
+                     and 'gap' otherwise. 'volume' falls back to 'gap' when
+                     the hull is not used.
+        tol: Stop when epsilon falls below tol. If None, run until max_iter
+             or n_samples is reached.
+        max_hull_dim: The convex hull is only computed up to this number of 
+                      dimensions. Above, or if the hull can not be computed,
+                      new directions are chosen among quasi-random 
+                      directions instead of facet normals.
+        n_probe: Number of directions the gap is evaluated in for 
+                 convergence='gap'. 
+        max_pairs: Maximum number of variable pairs projected onto for 
+                   convergence='projected'.
+        resume: Path of a checkpoint written by an earlier search with 
+                save_tmp_results=True. The search continues from the saved 
+                state without solving the saved directions again. 
+                max_iter and n_samples count the iterations and directions
+                of the earlier search as well.
+        """
         
+        if convergence not in [None, 'volume', 'gap', 'projected']:
+            raise ValueError(f'Unknown convergence {convergence}. '
+                             'Use volume, gap or projected')
+
         print('\n PyMGA: Searching near-optimal space using MAA method \n')
         start_time = time.time()
         
         dim = self.dim
         dim_fullD = dim
 
-        cluster, client = start_dask_cluster(workers=n_workers,
-                                             try_slurm=False)
+        with use_executor(executor or self.session, 
+                          n_workers, 
+                          self.case) as executor:
+            case_ref = executor.broadcast(self.case)
+            stream = DirectionStream(self.case, executor, case_ref)
 
-        max_n_dir = int(os.cpu_count())*20
-        old_volume = 0
-        epsilon = 1
-        directions_searched = np.empty([0, dim])
-        hull = None
+            max_n_dir = int(os.cpu_count())*20
+            epsilon = 1
+            old_volume = 0
 
-        vertices = np.empty(shape=[0, dim])
-        directions = np.empty((0, 0))
-        sol_fullD = np.empty(shape=[0, dim_fullD])
-        stat = np.empty(shape=[0])
-        cost = np.empty(shape=[0])
+            # Qhull is only used in low dimensions
+            use_hull = dim <= max_hull_dim
+            hull = RebuiltHull()
+            n_hull_vertices = 0
+            # Facet normals of the hull that have not been searched yet
+            open_facets = {}
+            dir_sampler = DirectionSampler(dim)
 
-        for i in range(max_iter):  # epsilon>MAA_convergence_tol:
+            if convergence is None:
+                convergence = 'volume' if use_hull else 'gap'
+            elif convergence == 'volume' and not use_hull:
+                print(f'The hull volume is not computed above {max_hull_dim} '
+                      'dimensions, using gap convergence instead')
+                convergence = 'gap'
+            probes = None
+            pairs = None
+            if convergence == 'gap':
+                probes = DirectionSampler(dim, rule='random').draw_dir(n_probe)
+            elif convergence == 'projected':
+                pairs = list(itertools.combinations(range(dim), 2))
+                if len(pairs) > max_pairs:
+                    pairs = [pairs[k] for k in np.random.choice(len(pairs),
+                                                                max_pairs,
+                                                                replace=False)]
+
+            if resume is not None:
+                state = load_checkpoint(resume, 'MAA', self.case.variables)
+                results = ResultStore.from_dict(state['results'])
+                searched_keys = state['searched_keys']
+                n_searched = state['n_searched']
+                start_iter = state['iteration']
+                old_volume = state['old_volume']
+                convergence = state['convergence']
+                use_hull = state['use_hull']
+                probes = state['probes']
+                pairs = state['pairs']
+                dir_sampler.count = state['sampler_count']
+                np.random.set_state(state['random_state'])
+                # Directions submitted before the search stopped, but not 
+                # solved, and directions selected in the last iteration
+                next_directions = state.get('next_directions', np.empty((0, dim)))
+                searched_keys.update(direction_key(d) for d in next_directions)
+                n_searched += len(next_directions)
+                directions = np.concatenate([state['pending'], next_directions])
+            else:
+                results = ResultStore(dim, dim_fullD)
+                start_iter = 0
 
-            if len(vertices) <= 1:
                 # logger.info('initializing directions')
                 directions = np.concatenate([np.diag(np.ones(dim)),
                                              -np.diag(np.ones(dim))],
                                             axis=0)
-            else:
-                directions = -np.array(hull.equations)[:, 0:-1]
-                if len(directions) > max_n_dir:
-                    directions = directions[np.random.choice(len(directions),
-                                                             max_n_dir)]
-
-            if (len(directions)+len(directions_searched)) >= n_samples:
-                remaining_evaluations = n_samples - len(directions_searched)
-                directions = directions[:remaining_evaluations]
-
-            directions_searched = np.concatenate([directions_searched,
-                                                  directions],
-                                                 axis=0)
-
-            # Run all searches in parallel using DASK
-            vertices, sol_fullD, stat, cost = solve_direcitons(directions,
-                                                                self.case,
-                                                                client,
-                                                                vertices,
-                                                                sol_fullD,
-                                                                stat,
-                                                                cost)
-
-            # logger.info('creating convex hull')
-            try:
-                hull = ConvexHull(vertices)
-                # ,qhull_options='Qs C-1e-32')#,qhull_options='A-0.99')
-            except Exception as e:
-                print('did not manage to create hull first try')
-                print(e)
-                try:
-                    hull = ConvexHull(vertices,
-                                      qhull_options='Qx Q12 C-1e-32')
-                except Exception as e:
-                    print('did not manage to create hull second try')
-                    print(e)
-
-            delta_v = hull.volume - old_volume
-            old_volume = hull.volume
-            epsilon = delta_v/hull.volume
-
-            print(f"""Iteration #{i},
-                    total vertices {len(vertices)},
-                    eps: {epsilon:.2f}""")
-                    
-            # Convert to dataframes
-            vertices   = pd.DataFrame(vertices, columns = self.case.variables)
-            directions_searched = pd.DataFrame(directions_searched, columns = self.case.variables)
-                    
-            # Save temporary results 
-            if save_tmp_results:
+                directions = directions[:n_samples]
+                searched_keys = {direction_key(d) for d in directions}
+                n_searched = len(directions)
+            if len(directions) > 0:
+                stream.submit(directions)
+            # Directions selected in the last iteration, which are not 
+            # searched but saved for a resumed search
+            next_directions = np.empty((0, dim))
+
+            def save_state(iteration):
+                # Save the search state, such that the search can be resumed
                 tmp_results = {}
-                tmp_results['project_name']   = self.case.project_name
-                tmp_results['vertces']       = vertices
-                tmp_results['directions']     = directions
+                tmp_results['project_name']   = getattr(self.case, 'project_name', None)
+                tmp_results['vertices']       = pd.DataFrame(results.vertices, columns = self.case.variables)
+                tmp_results['directions']     = pd.DataFrame(results.directions, columns = self.case.variables)
                 tmp_results['epsilon']        = epsilon
                 tmp_results['Method']         = 'MAA'
-                
-                # Create tmp folder if it does not exist
-                if not os.path.exists('tmp_results'):
-                    os.makedirs('tmp_results')
-                
-                # Export tmp results as pickle
-                with open(f'tmp_results/tmp_results_{self.case.project_name}.pkl', 'wb') as file:
-                    pickle.dump(tmp_results, file)
+                tmp_results['state']          = {
+                    'variables':     list(self.case.variables),
+                    'iteration':     iteration,
+                    'results':       results.to_dict(),
+                    'pending':       np.array(list(stream.pending.values())).reshape(-1, dim),
+                    'next_directions': next_directions,
+                    'searched_keys': searched_keys,
+                    'n_searched':    n_searched,
+                    'old_volume':    old_volume,
+                    'convergence':   convergence,
+                    'use_hull':      use_hull,
+                    'probes':        probes,
+                    'pairs':         pairs,
+                    'sampler_count': dir_sampler.count,
+                    'random_state':  np.random.get_state(),
+                    }
+                save_checkpoint(tmp_results, 
+                                resume or checkpoint_path(self.case))
+
+            for i in range(start_iter, max_iter):
+
+                # A resumed search continues from the saved vertices
+                resumed = i == start_iter and len(results) > 0
+                if len(stream) == 0 and not resumed:
+                    print('No new directions to search. Stopping')
+                    break
+
+                # Wait for new vertices. The first hull needs all initial vertices
+                min_results = None if i == 0 else min_vertices
+                solved_directions, res = stream.next_results(min_results)
+                results.add_results(solved_directions, res)
+                vertices = results.vertices
+                diameter = np.linalg.norm(np.ptp(vertices, axis=0))
+
+                # Add the new vertices to the hull
+                if use_hull:
+                    try:
+                        changed = hull.add_points(vertices[n_hull_vertices:])
+                        n_hull_vertices = len(vertices)
+                        # Only the new facets can add candidates. Facets
+                        # that are no longer part of the hull are dropped
+                        open_facets = {key: normal 
+                                       for key, normal in open_facets.items()
+                                       if key in hull.facet_keys}
+                        for k in changed:
+                            normal = -hull.equations[k, 0:-1]
+                            if direction_key(normal) not in searched_keys:
+                                open_facets[hull.keys[k]] = normal
+                    except Exception as e:
+                        print('did not manage to create hull, '
+                              'continuing without hull')
+                        print(e)
+                        use_hull = False
+                        if convergence == 'volume':
+                            convergence = 'gap'
+                            probes = DirectionSampler(dim, rule='random').draw_dir(n_probe)
+
+                # Convergence measure
+                if convergence == 'volume':
+                    volume = hull.volume
+                elif convergence == 'projected':
+                    volume = projected_volume(vertices, pairs)
+                if convergence == 'gap':
+                    probe_gaps = support_gaps(probes, 
+                                              results.directions, 
+                                              vertices,
+                                              executor=executor)
+                    epsilon = np.max(probe_gaps)/diameter
+                else:
+                    epsilon = (volume - old_volume)/volume
+                    old_volume = volume
+
+                print(f"""Iteration #{i},
+                        total vertices {len(vertices)},
+                        eps: {epsilon:.2f}""")
+
+                if tol is not None and i > 0 and epsilon < tol:
+                    print('Convergence tolerance reached. Stopping')
+                    break
+
+                # Candidates are the facet normals not searched yet, or
+                # quasi-random directions if the hull is not used
+                if use_hull:
+                    candidates = np.array(list(open_facets.values())).reshape(-1, dim)
+                else:
+                    candidates = dir_sampler.draw_dir(10*max_n_dir)
+                    new = [direction_key(d) not in searched_keys 
+                           for d in candidates]
+                    candidates = candidates[np.array(new, dtype=bool)]
+
+                remaining_evaluations = max(n_samples - n_searched, 0)
+                n_dir = min(max_n_dir, remaining_evaluations)
+
+                if selection == 'gap':
+                    # Bound the number of candidates scored in each iteration
+                    if len(candidates) > n_candidates:
+                        candidates = candidates[np.random.choice(len(candidates),
+                                                                 n_candidates,
+                                                                 replace=False)]
+                    # Searching d extends the space in the outward normal -d
+                    gaps = support_gaps(-candidates, 
+                                        results.directions, 
+                                        vertices,
+                                        executor=executor)
+                    directions = select_directions(candidates,
+                                                   gaps,
+                                                   n_dir,
+                                                   gap_tol=gap_tol*diameter)
+                    if len(gaps) > 0:
+                        print(f'Max gap {np.max(gaps):.3g}, '
+                              f'{len(directions)} directions selected')
+                else:
+                    directions = candidates
+                    if len(directions) > n_dir:
+                        directions = directions[np.random.choice(len(directions),
+                                                                 n_dir,
+                                                                 replace=False)]
+
+                if len(directions) > 0 and i < max_iter - 1:
+                    searched_keys.update(direction_key(d) for d in directions)
+                    n_searched += len(directions)
+                    stream.submit(directions)
+                    open_facets = {key: normal 
+                                   for key, normal in open_facets.items()
+                                   if direction_key(normal) not in searched_keys}
+                elif len(directions) > 0:
+                    next_directions = directions
                     
-        end_time = time.time()
-        print(f'\n PyMGA: Finished searching using MAA method \n Time used: {round(end_time - start_time,2)} s \n')
+                if save_tmp_results:
+                    save_state(i + 1)
+
+            # Collect directions still being solved
+            if len(stream) > 0:
+                solved_directions, res = stream.next_results()
+                results.add_results(solved_directions, res)
+                if save_tmp_results:
+                    save_state(max_iter)
+
+            # Convert to dataframes
+            vertices   = pd.DataFrame(results.vertices, columns = self.case.variables)
+            directions = pd.DataFrame(results.directions, columns = self.case.variables)
+                    
+            end_time = time.time()
+            print(f'\n PyMGA: Finished searching using MAA method \n Time used: {round(end_time - start_time,2)} s \n')
 
 
-        return vertices, directions_searched, stat, cost
+        return vertices, directions, results.stat, results.cost
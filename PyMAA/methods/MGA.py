@@ -1,15 +1,21 @@
 import numpy as np
-from ..utilities.general import solve_direcitons, DirectionSampler
-from ..utilities.dask_helpers import start_dask_cluster
+from ..utilities.general import (DirectionSampler,
+                                 DirectionStream,
+                                 ResultStore)
+from ..utilities.executors import use_executor
 import time
 import pandas as pd
 
 
 class MGA:
-    def __init__(self, case):
+    def __init__(self, case, session=None):
         """
+        case: case object to search
+        session: Executor shared between searches, e.g. a DaskSession. 
+                 If None, an executor is started and closed for each search.
         """
         self.case = case
+        self.session = session
         self.dim = len(case.variables)
 
     def find_optimum(self):
@@ -27,11 +33,14 @@ class MGA:
 
         return self.opt_sol, self.obj
 
-    def search_directions(self, n_samples, n_workers=4):
+    def search_directions(self, n_samples, n_workers=4, executor=None):
         """
         Performs the MGA study on the case study.
         The method draws random search directions
         uniformly over the hypersphere.
+        executor: Executor running the solves, or the name of the executor
+                  to start for this search: 'dask' (default), 'process', 
+                  'thread' or 'serial'. Defaults to the session of the method.
         """
 
         print('\n PyMGA: Searching near-optimal space using MGA method \n')
@@ -39,55 +48,49 @@ class MGA:
 
         dim = self.dim
 
-        cluster, client = start_dask_cluster(workers=n_workers,
-                                             try_slurm=False)
-
-        dim_fullD = len(self.case.variables)
-        # variables = list(self.case.variables.keys())[:dim]
-        vertices = np.empty(shape=[0, dim])
-        directions = np.empty((0, 0))
-        sol_fullD = np.empty(shape=[0, dim_fullD])
-        stat = np.empty(shape=[0])
-        cost = np.empty(shape=[0])
-
-        # timer = time.time()
-
-        # Direction sampler
-        dir_sampler = DirectionSampler(dim)
-        random_directions = dir_sampler.draw_dir(n_samples)
-        # Concatenate directions including max/min directions
-        directions = np.concatenate([np.diag(np.ones(dim)),
-                                    -np.diag(np.ones(dim)),
-                                    random_directions],
-                                    axis=0)
-
-        # logger.info(f'searching in {len(directions)} directions in total')
-
-        max_runs_per_iter = 500
-        n_direction = len(directions)
-        slices = np.concatenate((np.arange(0,
-                                 n_direction,
-                                 max_runs_per_iter),
-                                 [n_direction]))
-
-        for i in range(len(slices)-1):
-            idx_low = slices[i]
-            idx_high = slices[i+1]
-            directions_i = directions[idx_low:idx_high]
-            # logger.info(f'searching in {len(directions_i)}
-            # directions in total')
-            vertices, sol_fullD, stat, cost = solve_direcitons(directions_i,
-                                                                self.case,
-                                                                client,
-                                                                vertices,
-                                                                sol_fullD,
-                                                                stat,
-                                                                cost)
-        end_time = time.time()
-        print(f'\n PyMGA: Finished searching using MGA method \n Time used: {round(end_time - start_time,2)} s \n')
-
-        # Convert to dataframes
-        vertices   = pd.DataFrame(vertices, columns = self.case.variables)
-        directions = pd.DataFrame(directions, columns = self.case.variables)
-
-        return vertices, directions, stat, cost
+        with use_executor(executor or self.session, 
+                          n_workers, 
+                          self.case) as executor:
+            case_ref = executor.broadcast(self.case)
+
+            dim_fullD = len(self.case.variables)
+            # variables = list(self.case.variables.keys())[:dim]
+            results = ResultStore(dim, dim_fullD)
+
+            # timer = time.time()
+
+            # Direction sampler
+            dir_sampler = DirectionSampler(dim)
+            random_directions = dir_sampler.draw_dir(n_samples)
+            # Concatenate directions including max/min directions
+            directions = np.concatenate([np.diag(np.ones(dim)),
+                                        -np.diag(np.ones(dim)),
+                                        random_directions],
+                                        axis=0)
+
+            # logger.info(f'searching in {len(directions)} directions in total')
+
+            # Keep at most max_runs_per_iter directions on the cluster at a time
+            # and submit new directions as soon as others have been solved
+            max_runs_per_iter = 500
+            n_direction = len(directions)
+            n_submitted = 0
+            stream = DirectionStream(self.case, executor, case_ref)
+
+            while n_submitted < n_direction or len(stream) > 0:
+                n_new = min(max_runs_per_iter - len(stream),
+                            n_direction - n_submitted)
+                if n_new > 0:
+                    stream.submit(directions[n_submitted:n_submitted+n_new])
+                    n_submitted += n_new
+
+                solved_directions, res = stream.next_results(min_results=1)
+                results.add_results(solved_directions, res)
+            end_time = time.time()
+            print(f'\n PyMGA: Finished searching using MGA method \n Time used: {round(end_time - start_time,2)} s \n')
+
+            # Convert to dataframes
+            vertices   = pd.DataFrame(results.vertices, columns = self.case.variables)
+            directions = pd.DataFrame(results.directions, columns = self.case.variables)
+
+        return vertices, directions, results.stat, results.cost
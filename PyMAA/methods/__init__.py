@@ -2,3 +2,4 @@
 from .MAA import MAA
 from .MGA import MGA
 from .bMAA import bMAA
+from .mfMAA import mfMAA
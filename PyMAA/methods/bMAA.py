@@ -1,22 +1,29 @@
 import numpy as np
 import os
 import time
-import pickle
 import pandas as pd
 from ..utilities.general import (solve_direcitons,
+                                 ResultStore,
                                  DirectionSampler,
-                                 check_large_volume,
-                                 check_small_volume,
+                                 check_large_volume_batch,
+                                 check_small_volume_batch,
                                  calc_x0)
-from ..utilities.dask_helpers import start_dask_cluster
+from ..utilities.executors import use_executor
+from ..utilities.checkpoint import (checkpoint_path,
+                                    save_checkpoint,
+                                    load_checkpoint)
 from ..sampler.sampler import har_sample
 
 
 class bMAA:
-    def __init__(self, case):
+    def __init__(self, case, session=None):
         """
+        case: case object to search
+        session: Executor shared between searches, e.g. a DaskSession. 
+                 If None, an executor is started and closed for each search.
         """ 
         self.case = case
+        self.session = session
         self.dim = len(case.variables)
         
     def find_optimum(self):
@@ -40,133 +47,165 @@ class bMAA:
                           max_iter=30,
                           tol=0.99,
                           save_tmp_results = True,
+                          executor = None,
+                          resume = None,
                           ):
+        """
+        Performs the bMAA search of the near-optimal space.
+        resume: Path of a checkpoint written by an earlier search with 
+                save_tmp_results=True. The search continues from the saved 
+                state without solving the saved directions again. 
+                max_iter and n_samples count the iterations and directions
+                of the earlier search as well.
+        """
         print('\n PyMGA: Searching near-optimal space using bMAA method \n')
         start_time = time.time()
         
         dim = self.dim
         dim_fullD = dim
 
-        cluster, client = start_dask_cluster(workers=n_workers,
-                                             try_slurm=False)
-
-        stat = np.empty(shape=[0])
-        cost = np.empty(shape=[0])
-        directions = np.empty((0, 0))
-        samples = None
-        acc_small = None
-
-        for i in range(max_iter):
-            # Find directions
-            if len(directions) == 0:
-                print('initializing directions')
-                new_directions = np.concatenate((np.diag(np.ones(dim)),
-                                                -np.diag(np.ones(dim)),
-                                                np.ones((1, dim)),
-                                                -np.ones((1, dim))))
-                directions = new_directions.copy()
-                vertices = np.empty(shape=[0, dim])
-                sol_fullD = np.empty(shape=[0, dim_fullD])
+        with use_executor(executor or self.session, 
+                          n_workers, 
+                          self.case) as executor:
+            case_ref = executor.broadcast(self.case)
+
+            if resume is not None:
+                state = load_checkpoint(resume, 'bMAA', self.case.variables)
+                results = ResultStore.from_dict(state['results'])
+                n_searched = state['n_searched']
+                samples = state['samples']
+                acc_small = state['acc_small']
+                acc_rate = state['acc_rate']
+                start_iter = state['iteration']
+                np.random.set_state(state['random_state'])
             else:
-                print('searcing for new directions')
-                max_iter = int(os.cpu_count())*4
-                new_directions = find_new_directions(vertices,
-                                                     directions,
-                                                     samples,
-                                                     acc_small,
-                                                     client,
-                                                     max_iter=max_iter)
-                print(f'Found {len(new_directions)} new directions')
-
-                if (len(directions)+len(new_directions)) > n_samples:
-                    remaining_evaluations = n_samples-len(directions)
-                    new_directions = new_directions[:remaining_evaluations]
-
-                directions = np.append(directions, new_directions, axis=0)
-
-            # Solve directions
-            print(f'searching in {len(new_directions)} directions')
-            vertices, sol_fullD, stat, cost = solve_direcitons(new_directions,
-                                                                self.case,
-                                                                client,
-                                                                vertices,
-                                                                sol_fullD,
-                                                                stat,
-                                                                cost)
-            print('checking validity of samples')
-            test = []
-            for v in vertices:
-                test.append(check_large_volume(directions,
-                                               vertices,
-                                               v,
-                                               2000))
-            violators = np.where(~np.array(test))[0]
-
-            if len(violators) > 0:
-                print(f'Deleting {len(violators)} violators')
-                vertices = np.delete(vertices, violators, axis=0)
-                directions = np.delete(directions, violators, axis=0)
-
-            # Hit and run sample
-            print(f'Hit and run sampling, {har_samples} samples')
-            x0 = calc_x0(directions, vertices)
-            samples = har_sample(har_samples, x0, 
-                                 directions, vertices,
-                                 as_dataframes = False,
-                                 )
-            # samples = samples.values
-
-            # Find acceptance rate
-            acc_small = []
-            for i in range(len(samples)):
-                acc_small.append(check_small_volume(vertices, samples[i]))
-
-            acc_rate = np.mean(acc_small)
-
-            print(f"""Iteration #{i},
-                   total vertices {len(directions)},
-                   acceptance rate {acc_rate:.3f}""")
-
-            if acc_rate > tol:
-                break
-
-            if len(directions) >= n_samples:
-                print('Max function evaluations reached. Stopping')
-                break
-            
-        # Convert to dataframes
-        vertices   = pd.DataFrame(vertices, columns = self.case.variables)
-        directions = pd.DataFrame(directions, columns = self.case.variables)
-            
-        # Save temporary results 
-        if save_tmp_results:
-            tmp_results = {}
-            tmp_results['project_name']   = self.case.project_name
-            tmp_results['vertices']       = vertices
-            tmp_results['directions']     = directions
-            tmp_results['acc_rate']       = acc_rate
-            tmp_results['Method']         = 'bMAA'
-            
-            # Create tmp folder if it does not exist
-            if not os.path.exists('tmp_results'):
-                os.makedirs('tmp_results')
+                results = ResultStore(dim, dim_fullD)
+                n_searched = 0
+                samples = None
+                acc_small = None
+                acc_rate = 0
+                start_iter = 0
+            vertices = results.vertices
+            directions = results.directions
+
+            if resume is not None and (acc_rate > tol or n_searched >= n_samples):
+                print('Saved search has already stopped')
+                start_iter = max_iter
+
+            for i in range(start_iter, max_iter):
+                # Find directions
+                if n_searched == 0:
+                    print('initializing directions')
+                    new_directions = np.concatenate((np.diag(np.ones(dim)),
+                                                    -np.diag(np.ones(dim)),
+                                                    np.ones((1, dim)),
+                                                    -np.ones((1, dim))))
+                else:
+                    print('searcing for new directions')
+                    max_iter = int(os.cpu_count())*4
+                    new_directions = find_new_directions(results.vertices,
+                                                         results.directions,
+                                                         samples,
+                                                         acc_small,
+                                                         executor=executor,
+                                                         max_iter=max_iter)
+                    print(f'Found {len(new_directions)} new directions')
+
+                    if (n_searched+len(new_directions)) > n_samples:
+                        remaining_evaluations = n_samples-n_searched
+                        new_directions = new_directions[:remaining_evaluations]
+
+                # Solve directions
+                print(f'searching in {len(new_directions)} directions')
+                solve_direcitons(new_directions,
+                                 self.case,
+                                 executor,
+                                 results,
+                                 case_ref=case_ref)
+                n_searched += len(new_directions)
+
+                print('checking validity of samples')
+                vertices = results.vertices
+                directions = results.directions
+                violated, _ = check_large_volume_batch(directions,
+                                                       vertices,
+                                                       vertices,
+                                                       tol=2000)
+                violators = np.where(violated)[0]
+
+                if len(violators) > 0:
+                    print(f'Deleting {len(violators)} violators')
+                    results.delete(violators)
+                    vertices = results.vertices
+                    directions = results.directions
+
+                # Hit and run sample
+                print(f'Hit and run sampling, {har_samples} samples')
+                x0 = calc_x0(directions, vertices)
+                # The seed is drawn from np.random, whose state is saved in
+                # the checkpoint, so a resumed search continues the stream
+                samples = har_sample(har_samples, x0, 
+                                     directions, vertices,
+                                     as_dataframes = False,
+                                     seed = np.random.randint(2**31),
+                                     )
+                # samples = samples.values
+
+                # Find acceptance rate
+                acc_small = check_small_volume_batch(vertices, 
+                                                     samples, 
+                                                     executor)
+
+                acc_rate = np.mean(acc_small)
+
+                print(f"""Iteration #{i},
+                       total vertices {len(directions)},
+                       acceptance rate {acc_rate:.3f}""")
+
+                # Save the search state, such that the search can be resumed
+                if save_tmp_results:
+                    tmp_results = {}
+                    tmp_results['project_name']   = getattr(self.case, 'project_name', None)
+                    tmp_results['vertices']       = pd.DataFrame(vertices, columns = self.case.variables)
+                    tmp_results['directions']     = pd.DataFrame(directions, columns = self.case.variables)
+                    tmp_results['acc_rate']       = acc_rate
+                    tmp_results['Method']         = 'bMAA'
+                    tmp_results['state']          = {
+                        'variables':    list(self.case.variables),
+                        'iteration':    i + 1,
+                        'results':      results.to_dict(),
+                        'n_searched':   n_searched,
+                        'samples':      samples,
+                        'acc_small':    acc_small,
+                        'acc_rate':     acc_rate,
+                        'random_state': np.random.get_state(),
+                        }
+                    save_checkpoint(tmp_results, 
+                                    resume or checkpoint_path(self.case))
+
+                if acc_rate > tol:
+                    break
+
+                if n_searched >= n_samples:
+                    print('Max function evaluations reached. Stopping')
+                    break
             
-            # Export tmp results as pickle
-            with open(f'tmp_results/tmp_results_{self.case.project_name}.pkl', 'wb') as file:
-                pickle.dump(tmp_results, file)
+            # Convert to dataframes
+            vertices   = pd.DataFrame(vertices, columns = self.case.variables)
+            directions = pd.DataFrame(directions, columns = self.case.variables)
             
-        end_time = time.time()
-        print(f'\n PyMGA: Finished searching using bMAA method \n Time used: {round(end_time - start_time,2)} s \n')
+            end_time = time.time()
+            print(f'\n PyMGA: Finished searching using bMAA method \n Time used: {round(end_time - start_time,2)} s \n')
         
         
-        return vertices, directions, stat, cost
+        return vertices, directions, results.stat, results.cost
 
 
 def find_new_directions(vertices,
                         directions,
                         samples,
                         acc_small,
-                        client,
+                        executor=None,
                         max_iter=64,
                         min_count=1):
     """ Find new directions that result in the largest 
@@ -174,55 +213,71 @@ def find_new_directions(vertices,
     vertices: The vertices found with MAA method
     directions: Directions used in the MAA 
     samples: Hit-and-Run samples
-    client: DASK client 
+    executor: Executor the candidate directions are scored with when the
+              sample set is large, see select_best_direction.
+              If None, they are scored in this process.
     max_iter: maximum number of iterations
     min_count: minimum number of rejected samples
     returns
     new_direction: set of new directions
     """
     # Initialize 
-    updated_directions = directions
-    new_directions = np.empty((0, directions.shape[1]))
     updated_vertices = vertices
+    new_directions = []
     count = np.inf
     n_iter = 0
     # Samples that are between the two bounds
-    samples_between = samples[~np.array(acc_small)]
+    samples_between = samples[~np.asarray(acc_small, dtype=bool)]
     samples_remaining = samples_between
 
     while count > min_count and n_iter < max_iter:
 
         res = select_best_direction(updated_vertices,
-                                    updated_directions,
+                                    directions,
                                     samples_remaining,
-                                    client,
+                                    executor,
                                     n_new=2000,
                                     )
  
         best_dir, samples_remaining, count, v_best = res
 
-        updated_directions = np.concatenate((updated_directions, [best_dir]))
-        new_directions = np.concatenate((new_directions, [best_dir]))
+        new_directions.append(best_dir)
         updated_vertices = np.concatenate((updated_vertices, [v_best]))
 
         print(f'Rejecting {count},samples, #iter {n_iter},max k {0:.2f}')
         n_iter += 1 
 
-    return new_directions
+    return np.array(new_directions).reshape(-1, directions.shape[1])
+
+
+def count_rejected(chunk, samples):
+    """ Number of samples rejected by each direction in a chunk of 
+    (directions, offsets), i.e. samples with direction*s < offset """
+    test_directions, offsets = chunk
+    return np.sum(samples@test_directions.T < offsets, axis=0)
 
 
 def select_best_direction(vertices,
                           directions,
                           samples,
-                          client,
+                          executor=None,
                           n_new=500,
-                          n_samples=5000):
+                          n_samples=5000,
+                          chunk_size=None,
+                          min_parallel=int(5e7)):
     """ Find the direction resulting in the largest number of rejected samples
     vertices: The vertices found with MAA method
     directions: Directions used in the MAA 
     samples: Hit-and-Run samples
-    client: DASK client 
+    executor: Executor the candidate directions are scored with. 
+              If None, they are scored in this process.
     n_new: number of random directions to test
+    chunk_size: number of directions scored per matrix product. By default
+                the products hold about 10 million elements. 
+    min_parallel: The executor is only used when the number of samples
+                  times n_new is at least min_parallel, as sending the 
+                  samples to the workers costs more than scoring small
+                  sample sets in this process.
     returns
     best_dir: best direction
     samples_remaining: samples not rejected by new direction
@@ -233,15 +288,23 @@ def select_best_direction(vertices,
     dir_sampler = DirectionSampler(vertices.shape[1], rule='random')
     test_directions = dir_sampler.draw_dir(n_new)
 
-    counts = []
-
     # Find the vertex, furthest in direction of the dir_i
     idx = np.argmax(-test_directions@vertices.T, axis=1)
-    v = vertices[idx]
+    offsets = np.sum(test_directions*vertices[idx], axis=1)
+
     # Compute the number of samples rejected for each direction
-    for i in range(n_new):
-        samples_rejected = sum(test_directions[i]@(samples-v[i]).T < 0)
-        counts.append(samples_rejected)
+    if chunk_size is None:
+        chunk_size = max(int(1e7)//max(len(samples), 1), 1)
+    chunks = [(test_directions[start:start+chunk_size], 
+               offsets[start:start+chunk_size])
+              for start in range(0, n_new, chunk_size)]
+    if executor is None or len(samples)*n_new < min_parallel:
+        counts = [count_rejected(chunk, samples) for chunk in chunks]
+    else:
+        counts = executor.gather(executor.map(count_rejected, 
+                                              chunks, 
+                                              samples=samples))
+    counts = np.concatenate(counts)
 
     # Select the best direction
     idx_best_dir = np.argmax(counts)
@@ -249,8 +312,7 @@ def select_best_direction(vertices,
     v_best = vertices[idx[idx_best_dir]]
     
     # Fin the remaining samples
-    samples_remaining = samples[[best_dir@(s-v_best) > 0 for s in samples]]
+    samples_remaining = samples[samples@best_dir > offsets[idx_best_dir]]
     count = counts[idx_best_dir]
     
     return best_dir, samples_remaining, count, v_best
-    
\ No newline at end of file
@@ -0,0 +1,241 @@
+import numpy as np
+import time
+import pandas as pd
+from ..utilities.general import (DirectionStream,
+                                 ResultStore)
+from ..utilities.executors import use_executor
+from .MAA import MAA
+from .MGA import MGA
+from .bMAA import bMAA
+
+
+METHODS = {'MAA': MAA, 'bMAA': bMAA, 'MGA': MGA}
+
+
+class mfMAA:
+    def __init__(self, case, coarse_case, method='MAA', session=None):
+        """
+        Multi-fidelity search. The near-optimal space is explored on a
+        coarse version of the case, e.g. with aggregated snapshots, and only
+        the directions whose vertices contribute most to the hull are
+        solved again on the full case.
+        case: case object at full resolution
+        coarse_case: case object with the same variables at lower resolution
+        method: Method exploring the coarse case, 'MAA', 'bMAA' or 'MGA',
+                or the method class.
+        session: Executor shared between searches, e.g. a DaskSession.
+                 If None, an executor is started and closed for each search.
+        """
+        if list(case.variables) != list(coarse_case.variables):
+            raise ValueError('The coarse case must have the same variables '
+                             'as the case')
+        if isinstance(method, str):
+            if method not in METHODS:
+                raise ValueError(f'Unknown method {method}. '
+                                 'Use MAA, bMAA or MGA')
+            method = METHODS[method]
+        self.case = case
+        self.coarse_case = coarse_case
+        self.method = method
+        self.session = session
+        self.dim = len(case.variables)
+
+    def find_optimum(self):
+        """
+        Finds the cost optimal solution of both cases. The near-optimal
+        spaces of each case are defined relative to its own optimum.
+        Returns the optimum of the full case.
+        """
+        print('\n PyMGA: Finding optimal system of the coarse case \n')
+        start_time = time.time()
+        self.coarse_obj, _ = self.coarse_case.solve()
+        end_time = time.time()
+        print(f'\n PyMGA: Optimal coarse system found \n obj. value: {round(self.coarse_obj,2)} \n Time used: {round(end_time - start_time,2)}\n')
+
+        print('\n PyMGA: Finding optimal system \n')
+        start_time = time.time()
+        self.obj, opt_sol = self.case.solve()
+        self.opt_sol = pd.DataFrame([list(opt_sol.values())[:self.dim]],
+                                    columns = self.case.variables)
+        end_time = time.time()
+        print(f'\n PyMGA: Optimal system found \n obj. value: {round(self.obj,2)} \n Time used: {round(end_time - start_time,2)}\n')
+
+        return self.opt_sol, self.obj
+
+    def search_directions(self,
+                          n_samples,
+                          n_refine=None,
+                          correction='nearest',
+                          n_workers=4,
+                          executor=None,
+                          **kwargs):
+        """
+        Searches the coarse case with the method, and solves the n_refine
+        directions with the largest hull contribution on the full case.
+        The remaining vertices are kept from the coarse case, and are
+        marked by their status.
+        n_samples: Passed to the search of the coarse case.
+        n_refine: Number of directions solved on the full case. If None,
+                  a fifth of the coarse directions, and at least 2*dim.
+        correction: 'nearest' shifts each coarse vertex by the difference
+                    between the full and coarse vertex of the most similar
+                    refined direction, and gives it the status 'corrected'.
+                    If None, coarse vertices are kept as found and get the
+                    status 'coarse'.
+        executor: Executor running the solves, or the name of the executor
+                  to start for this search: 'dask' (default), 'process',
+                  'thread' or 'serial'. Defaults to the session of the method.
+        kwargs: Passed to search_directions of the method on the coarse case.
+        """
+        if correction not in ['nearest', None]:
+            raise ValueError(f'Unknown correction {correction}. '
+                             'Use nearest or None')
+
+        print(f'\n PyMGA: Searching near-optimal space using multi-fidelity '
+              f'{self.method.__name__} method \n')
+        start_time = time.time()
+
+        dim = self.dim
+
+        with use_executor(executor or self.session,
+                          n_workers,
+                          self.case) as executor:
+            # Explore the coarse case
+            coarse_method = self.method(self.coarse_case, session=executor)
+            (coarse_vertices,
+             coarse_directions,
+             _,
+             coarse_cost) = coarse_method.search_directions(n_samples,
+                                                            n_workers=n_workers,
+                                                            **kwargs)
+            coarse_vertices = coarse_vertices.values
+            coarse_directions = coarse_directions.values
+
+            # Solve the most informative directions on the full case
+            if n_refine is None:
+                n_refine = max(len(coarse_directions)//5, 2*dim)
+            contribution = hull_contribution(coarse_directions, coarse_vertices)
+            refine = select_refinement(contribution, coarse_vertices, n_refine)
+            print(f'Solving {len(refine)} of {len(coarse_directions)} '
+                  'directions on the full case')
+
+            stream = DirectionStream(self.case, executor)
+            stream.submit(coarse_directions[refine])
+            solved_directions, res = stream.next_results()
+            # Keep the results in the order of the submitted directions
+            order = {tuple(d): k for k, d in enumerate(solved_directions)}
+            res = [res[order[tuple(d)]] for d in coarse_directions[refine]]
+            results = ResultStore(dim, dim)
+            solved = results.add_results(coarse_directions[refine], res)
+            refine = refine[solved]
+
+        vertices = coarse_vertices.copy()
+        stat = np.full(len(vertices), 'coarse', dtype=object)
+        cost = np.array(coarse_cost, dtype=float)
+        vertices[refine] = results.vertices
+        stat[refine] = results.stat
+        cost[refine] = results.cost
+
+        coarse = np.ones(len(vertices), dtype=bool)
+        coarse[refine] = False
+        if correction == 'nearest' and len(refine) > 0:
+            vertices[coarse] = correct_vertices(coarse_directions[coarse],
+                                                coarse_vertices[coarse],
+                                                coarse_directions[refine],
+                                                coarse_vertices[refine],
+                                                results.vertices)
+            stat[coarse] = 'corrected'
+
+        # Convert to dataframes
+        vertices   = pd.DataFrame(vertices, columns = self.case.variables)
+        directions = pd.DataFrame(coarse_directions, columns = self.case.variables)
+
+        end_time = time.time()
+        print(f'\n PyMGA: Finished searching using multi-fidelity method \n Time used: {round(end_time - start_time,2)} s \n')
+
+        return vertices, directions, stat, cost
+
+
+def hull_contribution(directions, vertices, chunk_size=None):
+    """
+    Contribution of each vertex to the hull of the vertices, measured as
+    the distance the vertex extends the hull beyond all other vertices in
+    its own search direction. Vertices that are duplicates of other
+    vertices are not counted as other vertices. Duplicates are removed
+    first, and the vertices are compared in chunks of rows, so memory
+    grows linearly with the number of vertices.
+
+    Parameters:
+    - directions (np.array): Search direction of each vertex.
+    - vertices (np.array): Vertex found in each direction.
+    - chunk_size (int, optional): Number of vertices compared per matrix
+                                  product. By default the products hold
+                                  about a million elements.
+
+    Returns:
+    - contribution (np.array): Contribution of each vertex. Zero for
+                               vertices inside the hull of the others.
+    """
+    directions = directions/np.linalg.norm(directions, axis=1, keepdims=True)
+    scale = max(np.linalg.norm(np.ptp(vertices, axis=0)), 1e-12)
+    unique, inverse = np.unique(np.round(vertices/scale, 6),
+                                axis=0,
+                                return_inverse=True)
+    inverse = inverse.ravel()
+    unique = unique*scale
+    if chunk_size is None:
+        chunk_size = max(int(1e6)//len(unique), 1)
+
+    # d_j*v_j, and the smallest d_j*v_k over the other distinct vertices
+    own = np.sum(directions*vertices, axis=1)
+    others = np.empty(len(vertices))
+    for start in range(0, len(vertices), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(vertices)))
+        projections = directions[rows] @ unique.T
+        projections[np.arange(len(rows)), inverse[rows]] = np.inf
+        others[rows] = np.min(projections, axis=1)
+
+    contribution = others - own
+    return np.clip(np.nan_to_num(contribution, posinf=scale), 0, None)
+
+
+def select_refinement(contribution, vertices, n_refine):
+    """
+    Indices of the n_refine vertices with the largest contribution,
+    skipping duplicates of vertices already selected.
+    """
+    scale = max(np.linalg.norm(np.ptp(vertices, axis=0)), 1e-12)
+    selected = []
+    for k in np.argsort(-contribution, kind='stable'):
+        if len(selected) >= n_refine:
+            break
+        if len(selected) > 0 and np.min(np.linalg.norm(vertices[selected] - vertices[k],
+                                                       axis=1)) <= 1e-6*scale:
+            continue
+        selected.append(k)
+    return np.sort(np.array(selected, dtype=int))
+
+
+def correct_vertices(directions, vertices, refined_directions,
+                     refined_coarse, refined_full):
+    """
+    Shift each coarse vertex by the difference between the full and
+    coarse vertex of the refined direction with the largest cosine
+    similarity to its direction.
+
+    Parameters:
+    - directions (np.array): Directions of the coarse vertices.
+    - vertices (np.array): Coarse vertices to correct.
+    - refined_directions (np.array): Directions solved on both cases.
+    - refined_coarse (np.array): Coarse vertex of each refined direction.
+    - refined_full (np.array): Full vertex of each refined direction.
+
+    Returns:
+    - corrected (np.array): The corrected vertices.
+    """
+    directions = directions/np.linalg.norm(directions, axis=1, keepdims=True)
+    refined_directions = refined_directions/np.linalg.norm(refined_directions,
+                                                           axis=1,
+                                                           keepdims=True)
+    nearest = np.argmax(directions @ refined_directions.T, axis=1)
+    return vertices + (refined_full - refined_coarse)[nearest]
@@ -1,2 +1,3 @@
 from .sampler import har_sample
-from .sampler import bayesian_sample
\ No newline at end of file
+from .sampler import bayesian_sample
+from .sampler import write_samples
\ No newline at end of file
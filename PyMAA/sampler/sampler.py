@@ -1,9 +1,12 @@
+import math
 import numpy as np
 import pandas as pd
-from ..utilities.general import check_large_volume, calc_x0, DirectionSampler
+from ..utilities.general import check_large_volume, calc_x0
 
 
-def har_sample(n_samples, x0, directions, vertices, as_dataframes = True):
+def har_sample(n_samples, x0, directions, vertices, as_dataframes = True,
+               n_chains = 1, burn_in = 0, thinning = 1, seed = None,
+               chunk_size = None, out = None, dtype = None):
     """ 
     Hit-and-Run sampler for generating samples within a polytope.
     Generates samples from within a polytope, which is defined as hyperplanes 
@@ -11,6 +14,9 @@ def har_sample(n_samples, x0, directions, vertices, as_dataframes = True):
     the MAA algorithm. The starting point (x0) must be within the polytope.
     Returning as dataframes can be turned off, as dataframes are not supported
     internally in the bMAA method, where this function is also used.
+    Runs n_chains independent chains from x0, which are advanced together
+    as batched array operations. Each chain draws its random numbers from 
+    its own np.random.Generator, spawned from seed.
 
     Parameters:
     - n_samples (int): Number of samples to draw.
@@ -20,13 +26,29 @@ def har_sample(n_samples, x0, directions, vertices, as_dataframes = True):
     - vertices (pd.DataFrame): Vertices found by searching in directions 
                                with the MAA algorithm.
     - as_dataframes (bool): Whether to use dataframes for input and output
+    - n_chains (int): Number of chains sampled in parallel.
+    - burn_in (int): Number of steps of each chain discarded before samples
+                     are kept.
+    - thinning (int): Keep every thinning'th step of each chain.
+    - seed (int, optional): Seed of the chains. Sampling with the same seed
+                            and number of chains is reproducible.
+    - chunk_size (int, optional): If given, return a generator yielding the
+                                  samples in chunks of chunk_size, such
+                                  that all samples never are in memory.
+    - out (str, optional): Write the samples to a .npy or .parquet file 
+                           instead of returning them. See write_samples.
+    - dtype (optional): Data type of the samples. Defaults to float32 when 
+                        writing to a file, and float64 otherwise.
 
     Returns:
     - samples (pd.DataFrame): DataFrame containing generated samples.
+                              A generator of chunks if chunk_size is given,
+                              and the written file if out is given.
     
     """
     
     # Take values without dataframes
+    variables = None
     if as_dataframes == True:
         variables = vertices.columns
         vertices = vertices.values
@@ -43,35 +65,163 @@ def har_sample(n_samples, x0, directions, vertices, as_dataframes = True):
     # normalvectors and offsets.
     # Offset is the distance from origo to the
     # plane in the normal direction.
-    offsets = [directions[i]@(-vertices[i]) for i in range(len(directions))]
+    offsets = np.sum(directions*-vertices, axis=1)
     A = -directions  # Matrix containing all normal vectors
     b = offsets  # vector of offsets
 
+    blocks = _har_blocks(A, b, x0, n_samples, n_chains, burn_in, thinning, seed)
+
+    return _output_samples(blocks, n_samples, len(x0), variables,
+                           chunk_size, out, dtype)
+
+
+def _har_blocks(A, b, x0, n_samples, n_chains, burn_in, thinning, seed):
+    # Generator running the Hit-and-Run chains in the polytope A*x <= b.
+    # Yields the samples kept in each block of steps.
+
     # Initialize parameters
-    x_i = x0
-    samples = np.empty((n_samples, len(x0)))
-    dir_sampler = DirectionSampler(len(x0))
-    directions = dir_sampler.draw_dir(n_samples)
-    for j in range(n_samples):
-        direct_i = directions[j]
-        # Distances from x_i to bounding planes in direction direct_i
-        t_range = (b-A@x_i)/(A@direct_i)
-        filt_max = A@direct_i > 0
-        filt_min = A@direct_i < 0
-        lambda_max = min(t_range[filt_max])  # Maximum stepsize
-        lambda_min = max(t_range[filt_min])  # Minimum stepsize
-        lambda_i = np.random.uniform(lambda_min, lambda_max, 1)
-        x_new = x_i+direct_i*lambda_i
-        
-        samples[j, :] = x_new
-        x_i = x_new    
-        
-    if as_dataframes == True:
-        samples   = pd.DataFrame(samples, columns = variables)
+    dim = len(x0)
+    n_steps = -(-n_samples//n_chains)  # Kept steps per chain
+    rngs = [np.random.default_rng(s) 
+            for s in np.random.SeedSequence(seed).spawn(n_chains)]
+    x_i = np.tile(np.asarray(x0, dtype=float), (n_chains, 1))
+
+    total_steps = burn_in + n_steps*thinning
+    # Steps drawn from the generators at a time. The slack b - A*x is 
+    # updated along each step, and recomputed at the start of each block 
+    # to remove accumulated rounding errors.
+    block = 1000
+    for start in range(0, total_steps, block):
+        n_block = min(block, total_steps - start)
+        # Random directions and positions on the line for each chain
+        direct = np.stack([rng.standard_normal((n_block, dim)) 
+                           for rng in rngs], axis=1)
+        direct /= np.linalg.norm(direct, axis=2, keepdims=True)
+        u = np.stack([rng.random(n_block) for rng in rngs], axis=1)
+        Ad_block = direct@A.T
+        slack = b - x_i@A.T
+
+        kept = []
+        with np.errstate(divide='ignore', invalid='ignore'):
+            for k in range(n_block):
+                Ad = Ad_block[k]
+                # Distances from x_i to bounding planes in direction direct_i
+                t_range = slack/Ad
+                lambda_max = np.min(t_range, axis=1, where=Ad > 0, initial=np.inf)
+                lambda_min = np.max(t_range, axis=1, where=Ad < 0, initial=-np.inf)
+                lambda_i = lambda_min + u[k]*(lambda_max - lambda_min)
+                x_i = x_i + direct[k]*lambda_i[:, None]
+                slack -= lambda_i[:, None]*Ad
+
+                step = start + k - burn_in
+                if step >= 0 and step % thinning == thinning - 1:
+                    kept.append(x_i)
 
+        if len(kept) > 0:
+            yield np.concatenate(kept)
+
+
+def _rechunk(blocks, n_samples, chunk_size):
+    # Regroup blocks of samples into chunks of chunk_size rows,
+    # stopping after n_samples rows
+    buffer = []
+    n_buffer = 0
+    n_yielded = 0
+    for block in blocks:
+        block = block[:n_samples - n_yielded - n_buffer]
+        buffer.append(block)
+        n_buffer += len(block)
+        while n_buffer >= chunk_size:
+            data = np.concatenate(buffer)
+            yield data[:chunk_size]
+            n_yielded += chunk_size
+            buffer = [data[chunk_size:]]
+            n_buffer -= chunk_size
+        if n_yielded + n_buffer >= n_samples:
+            break
+    if n_buffer > 0:
+        yield np.concatenate(buffer)
+
+
+def _output_samples(blocks, n_samples, dim, variables, chunk_size, out, dtype):
+    # Return the sampled blocks as the sampler was asked to
+    if out is not None:
+        return write_samples(_rechunk(blocks, n_samples, chunk_size or 100_000),
+                             out, n_samples, dim, 
+                             variables=variables,
+                             dtype=dtype or np.float32)
+
+    dtype = dtype or np.float64
+    if chunk_size is not None:
+        return (chunk.astype(dtype, copy=False) if variables is None
+                else pd.DataFrame(chunk.astype(dtype, copy=False), columns=variables)
+                for chunk in _rechunk(blocks, n_samples, chunk_size))
+
+    samples = np.empty((n_samples, dim), dtype=dtype)
+    n = 0
+    for chunk in _rechunk(blocks, n_samples, 100_000):
+        samples[n:n+len(chunk)] = chunk
+        n += len(chunk)
+    samples = samples[:n]
+
+    if variables is not None:
+        samples = pd.DataFrame(samples, columns=variables, copy=False)
     return samples
 
-def bayesian_sample(n_samples, vertices):
+
+def write_samples(chunks, path, n_samples, dim, variables=None, dtype=np.float32):
+    """
+    Write chunks of samples to a file as they are generated, such that the
+    samples never all are in memory.
+
+    Parameters:
+    - chunks (iterable): Arrays of samples, one sample per row.
+    - path (str): File to write. A .npy file is written as a memory-mapped
+                  array, which can be opened with 
+                  np.load(path, mmap_mode='r'). A .parquet file is written
+                  with one row group per chunk and requires pyarrow.
+    - n_samples (int): Number of samples that will be written.
+    - dim (int): Number of variables.
+    - variables (list, optional): Names of the variables, used as column 
+                                  names in parquet files.
+    - dtype (optional): Data type the samples are stored as.
+
+    Returns:
+    - samples (np.memmap or str): The memory-mapped samples for .npy files,
+                                  or the path of the parquet file.
+    """
+    if path.endswith('.npy'):
+        samples = np.lib.format.open_memmap(path, mode='w+', 
+                                            dtype=dtype, 
+                                            shape=(n_samples, dim))
+        n = 0
+        for chunk in chunks:
+            samples[n:n+len(chunk)] = chunk
+            n += len(chunk)
+        samples.flush()
+        return samples
+
+    elif path.endswith('.parquet'):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if variables is None:
+            variables = [f'x{i}' for i in range(dim)]
+        schema = pa.schema([(str(v), pa.from_numpy_dtype(np.dtype(dtype))) 
+                            for v in variables])
+        with pq.ParquetWriter(path, schema) as writer:
+            for chunk in chunks:
+                chunk = chunk.astype(dtype, copy=False)
+                writer.write_table(pa.Table.from_arrays(list(chunk.T), 
+                                                        schema=schema))
+        return path
+
+    raise ValueError(f'Can not write samples to {path}. '
+                     'Use a .npy or .parquet file')
+
+
+def bayesian_sample(n_samples, vertices, chunk_size = None, out = None, 
+                    dtype = None, seed = None, decomposition = 'delaunay'):
     '''
     Bayesian Bootstrap sampler for generating samples within a polytope.
     Generates samples within a polytope by computing the convex hull from the 
@@ -79,17 +229,39 @@ def bayesian_sample(n_samples, vertices):
     hull into simplexes, and samples each simplex uniformly. Number of samples
     per simplex is determined based on the volume of each simplex.
     Partially adapted from https://stackoverflow.com/questions/59073952/how-to-get-uniformly-distributed-points-in-convex-hull
+    The number of samples per simplex is drawn from a multinomial 
+    distribution, so the counts add up to n_samples. The barycentric weights
+    of all samples are drawn from a flat Dirichlet distribution at once, and
+    multiplied with the simplex vertices in one batched product.
+    With decomposition='cone', the hull is split into one simplex per facet,
+    as the cone from the Chebyshev center of the hull to the facet. This 
+    avoids the Delaunay triangulation, whose number of simplexes grows 
+    quickly with the dimension.
 
     Parameters:
     - n_samples (int): Number of samples to draw.
     - vertices (pd.DataFrame): DataFrame containing vertices of the polytope
+    - chunk_size (int, optional): If given, return a generator yielding the
+                                  samples in chunks of chunk_size, such
+                                  that all samples never are in memory.
+    - out (str, optional): Write the samples to a .npy or .parquet file 
+                           instead of returning them. See write_samples.
+    - dtype (optional): Data type of the samples. Defaults to float32 when 
+                        writing to a file, and float64 otherwise.
+    - seed (int, optional): Seed of the np.random.Generator drawing the 
+                            samples.
+    - decomposition (str): How the hull is split into simplexes. 
+                           'delaunay' (default) or 'cone'.
 
     Returns:
     - samples (pd.DataFrame): DataFrame containing generated samples.
+                              A generator of chunks if chunk_size is given,
+                              and the written file if out is given.
 
-    Note: This method is mainly useful for spaces with 6 or less dimensions.
+    Note: With decomposition='delaunay', this method is mainly useful for 
+    spaces with 6 or less dimensions. With 'cone' it can be used up to 
+    around 9 dimensions, where the convex hull can still be computed.
     '''
-    import random
     import numpy as np
     from numpy.linalg import det
     from scipy.spatial import Delaunay
@@ -100,44 +272,63 @@ def bayesian_sample(n_samples, vertices):
     vertices = vertices.values
     
     dims = vertices.shape[-1]                      # Determine dimension of simplexes
-    hull = vertices[ConvexHull(vertices).vertices] # Vertices
-    deln = hull[Delaunay(hull).simplices]          # Split hull into simplexes
+    if decomposition == 'delaunay':
+        hull = vertices[ConvexHull(vertices).vertices] # Vertices
+        deln = hull[Delaunay(hull).simplices]          # Split hull into simplexes
+    elif decomposition == 'cone':
+        deln = _cone_simplices(ConvexHull(vertices))
+    else:
+        raise ValueError(f'Unknown decomposition {decomposition}. '
+                         'Use delaunay or cone')
 
     # Calculate volume of simplexes   
-    vols = np.abs(det(deln[:, :dims, :] - deln[:, dims:, :])) / np.math.factorial(dims) 
+    vols = np.abs(det(deln[:, :dims, :] - deln[:, dims:, :])) / math.factorial(dims) 
     
     #### Find number of samples pr. simplex from their volume
-    samples_pr_simplex = [None] * vols.shape[-1]
-    for k in range(vols.shape[-1]):    
-        samples_pr_simplex[k] = int(np.round(vols[k]/vols.sum()*n_samples))
+    rng = np.random.default_rng(seed)
+    samples_pr_simplex = rng.multinomial(n_samples, vols/vols.sum())
     
-    #### Find random samples
-    samples = np.zeros(shape=(sum(samples_pr_simplex),dims))
-    counter = 0
-    for l in range(vols.shape[-1]):
-            for ll in range(samples_pr_simplex[l]):
-               
-                #### Find random vector which sums to 1
-                a_list = [0,1]
-                for i in range(dims): 
-                    a_list.insert(i+1, random.uniform(0, 1))
-                    a_list.sort()
-                
-                r = [None] * (dims+1)
-                for j in range(len(a_list)-1):
-                    r[j] = a_list[j+1] - a_list[j]
-                random.shuffle(r)
-                
-                #### Sample the space
-                sample_x = np.zeros(shape=(1,dims))
-
-                for k in range(deln.shape[1]):
-                    sample_x = np.add(deln[l][k]*r[k], sample_x)
-                           
-                samples[counter] = sample_x
-                counter = counter + 1
-        
-    # Put samples in dataframe for clarity
-    samples   = pd.DataFrame(samples, columns = variables)
-        
-    return samples
+    blocks = _bayesian_blocks(deln, samples_pr_simplex, rng)
+
+    return _output_samples(blocks, n_samples, dims, variables,
+                           chunk_size, out, dtype)
+
+
+def _cone_simplices(hull):
+    # Split the hull into the simplexes spanned by each (triangulated) facet 
+    # and the Chebyshev center of the hull, which lies inside all facets.
+    from scipy.optimize import linprog
+
+    # Maximize r such that the ball around c with radius r is inside all
+    # facets n*x + offset <= 0, where the normals n have unit length
+    normals = hull.equations[:, :-1]
+    offsets = hull.equations[:, -1]
+    dims = normals.shape[1]
+    c = np.zeros(dims + 1)
+    c[-1] = -1
+    res = linprog(c,
+                  A_ub=np.hstack([normals, np.ones((len(normals), 1))]),
+                  b_ub=-offsets,
+                  bounds=[(None, None)]*dims + [(0, None)],
+                  method='highs')
+    if res.status != 0:
+        raise ValueError('Could not find the Chebyshev center of the hull '
+                         f'for the cone decomposition: {res.message} '
+                         "Use decomposition='delaunay' instead.")
+    center = res.x[:dims]
+
+    facets = hull.points[hull.simplices]
+    apex = np.broadcast_to(center, (len(facets), 1, dims))
+    return np.concatenate([facets, apex], axis=1)
+
+
+def _bayesian_blocks(deln, samples_pr_simplex, rng, block=100_000):
+    # Generator sampling the simplexes uniformly. 
+    # Yields the samples in blocks of up to block samples.
+    simplex_idx = np.repeat(np.arange(len(deln)), samples_pr_simplex)
+    for start in range(0, len(simplex_idx), block):
+        idx = simplex_idx[start:start+block]
+        # Uniform barycentric weights, i.e. random vectors which sum to 1
+        weights = rng.dirichlet(np.ones(deln.shape[1]), size=len(idx))
+        # Sample the space
+        yield np.einsum('nk,nkd->nd', weights, deln[idx])
@@ -0,0 +1,67 @@
+import os
+import pickle
+import tempfile
+
+
+def checkpoint_path(case):
+    """ Default path of the checkpoint of a search of the case:
+    tmp_results/tmp_results_<project_name>.pkl in the working directory """
+    name = getattr(case, 'project_name', type(case).__name__)
+    return os.path.join('tmp_results', f'tmp_results_{name}.pkl')
+
+
+def save_checkpoint(state, path):
+    """
+    Write the search state to path atomically. The state is pickled to a
+    temporary file in the same folder, which then replaces the checkpoint.
+    A search killed while writing leaves the previous checkpoint intact.
+
+    Parameters:
+    - state (dict): Search state to save.
+    - path (str): Path of the checkpoint.
+    """
+    folder = os.path.dirname(path) or '.'
+    os.makedirs(folder, exist_ok=True)
+
+    fd, tmp_path = tempfile.mkstemp(dir=folder, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            pickle.dump(state, file)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def load_checkpoint(path, method, variables):
+    """
+    Load a search state written by save_checkpoint, and check that it was
+    written by the same method for the same variables.
+
+    Parameters:
+    - path (str): Path of the checkpoint.
+    - method (str): Name of the method resuming the search, e.g. 'MAA'.
+    - variables (list): Variables of the case being searched.
+
+    Returns:
+    - state (dict): The saved search state.
+    """
+    with open(path, 'rb') as file:
+        state = pickle.load(file)
+
+    if 'state' not in state:
+        raise ValueError(f'{path} does not contain a resumable search state')
+    if state['Method'] != method:
+        raise ValueError(f'{path} was written by {state["Method"]}, '
+                         f'and can not be resumed by {method}')
+    if list(state['state']['variables']) != list(variables):
+        raise ValueError(f'{path} was written for the variables '
+                         f'{list(state["state"]["variables"])}, '
+                         f'not {list(variables)}')
+
+    print(f'Resuming {method} search from {path}, '
+          f'iteration #{state["state"]["iteration"]}')
+    return state['state']
@@ -1,28 +1,71 @@
-from dask.distributed import Client, LocalCluster
+from dask.distributed import Client, LocalCluster, wait
 from dask_jobqueue import SLURMCluster
+from .executors import Executor, limit_workers
 
 
 def start_dask_cluster(workers=32, try_slurm=True):
-    try: 
-        client = Client()
-        cluster = None
-    except Exception as e: 
-        print('Error', e)
-        if try_slurm:
-            try: 
-                cluster = SLURMCluster(log_directory='logs/',
-                                       walltime='24:00:00')
-                print('started slurm cluster')
-                cluster.scale(workers)
-            except Exception as e:
-                print('Error', e)
-                cluster = LocalCluster(scheduler_port=8786,
-                                       processes=True)
-                print('started local cluster')
-        else:
-            cluster = LocalCluster(scheduler_port=8786,
-                                   processes=True)
-            print('started local cluster')
-        client = Client(cluster)
+    cluster = None
+    if try_slurm:
+        try: 
+            cluster = SLURMCluster(log_directory='logs/',
+                                   walltime='24:00:00')
+            print('started slurm cluster')
+            cluster.scale(workers)
+        except Exception as e:
+            print('Error', e)
+            cluster = None
+    if cluster is None:
+        # One task per worker process, as each solve is multi-threaded
+        cluster = LocalCluster(n_workers=workers,
+                               threads_per_worker=1,
+                               processes=True)
+        print('started local cluster')
+    client = Client(cluster)
     return cluster, client
 
+
+class DaskSession(Executor):
+    """
+    A DASK cluster and client that can be shared by several searches, 
+    e.g. when searching with several slack values in one script.
+    Each worker solves one direction at a time. On a local cluster, the
+    number of workers is limited such that the workers times the solver 
+    threads do not exceed the number of CPU cores.
+    The cluster is shut down by close(), or when used as a context manager.
+
+    Parameters:
+    - n_workers (int): Number of workers.
+    - solver_threads (int): Number of threads used by the solver in each solve.
+    - try_slurm (bool): Try to start a SLURM cluster before a local cluster.
+
+    Example:
+    > with DaskSession(n_workers=8, solver_threads=2) as session:
+    >     method = PyMAA.methods.MAA(case, session=session)
+    """
+    def __init__(self, n_workers=4, solver_threads=1, try_slurm=False):
+        if not try_slurm:
+            n_workers = limit_workers(n_workers, solver_threads)
+
+        self.n_workers = n_workers
+        self.solver_threads = solver_threads
+        self.cluster, self.client = start_dask_cluster(workers=n_workers,
+                                                       try_slurm=try_slurm)
+
+    def broadcast(self, obj):
+        # Scatter obj to all workers once, such that it is not serialized
+        # with every task
+        return self.client.scatter(obj, broadcast=True, hash=False)
+
+    def map(self, fn, iterable, **kwargs):
+        return self.client.map(fn, iterable, pure=False, **kwargs)
+
+    def wait(self, futures):
+        return wait(futures, return_when='FIRST_COMPLETED')
+
+    def gather(self, futures):
+        return self.client.gather(futures)
+
+    def close(self):
+        self.client.close()
+        if self.cluster is not None:
+            self.cluster.close()
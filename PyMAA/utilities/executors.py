@@ -0,0 +1,202 @@
+import os
+import itertools
+import concurrent.futures as cf
+from contextlib import contextmanager
+
+
+class Executor:
+    """
+    Base class for the backends that solve directions in parallel.
+    A backend implements broadcast() and map(). The returned futures must
+    have done() and result() methods, and work with wait().
+    Backends are closed by close(), or when used as a context manager.
+    """
+    def broadcast(self, obj):
+        """ Send obj to all workers once. Returns the object to pass to the
+        tasks in place of obj. """
+        return obj
+
+    def map(self, fn, iterable, **kwargs):
+        """ Submit fn(item, **kwargs) for each item and return the futures """
+        raise NotImplementedError
+
+    def wait(self, futures):
+        """ Wait until at least one of the futures is done.
+        Returns the done and not done futures """
+        return cf.wait(futures, return_when=cf.FIRST_COMPLETED)
+
+    def gather(self, futures):
+        return [future.result() for future in futures]
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class SerialExecutor(Executor):
+    """
+    Solves each direction in the calling process when it is submitted.
+    Has no startup cost, which makes it the fastest choice for the synthetic
+    test cases and for debugging.
+    """
+    def map(self, fn, iterable, **kwargs):
+        futures = []
+        for item in iterable:
+            future = cf.Future()
+            try:
+                future.set_result(fn(item, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+            futures.append(future)
+        return futures
+
+
+class ThreadExecutor(Executor):
+    """
+    Solves directions in a pool of threads in the calling process.
+    Only useful when the solver releases the GIL while solving, as e.g.
+    gurobipy does. Each thread keeps its own cached network and persistent
+    model.
+
+    Parameters:
+    - n_workers (int): Number of threads.
+    """
+    def __init__(self, n_workers=4):
+        self.n_workers = n_workers
+        self.pool = cf.ThreadPoolExecutor(max_workers=n_workers)
+
+    def map(self, fn, iterable, **kwargs):
+        return [self.pool.submit(fn, item, **kwargs) for item in iterable]
+
+    def close(self):
+        self.pool.shutdown()
+
+
+class BroadcastRef:
+    """ Reference to an object broadcast to the workers of a ProcessExecutor """
+    def __init__(self, key):
+        self.key = key
+
+
+# Objects broadcast to this worker process
+_worker_objects = {}
+
+def _set_worker_objects(objects):
+    _worker_objects.clear()
+    _worker_objects.update(objects)
+
+def _call_with_objects(fn, item, kwargs):
+    # Replace references to broadcast objects by the objects of the worker
+    kwargs = {k: _worker_objects[v.key] if isinstance(v, BroadcastRef) else v
+              for k, v in kwargs.items()}
+    return fn(item, **kwargs)
+
+
+class ProcessExecutor(Executor):
+    """
+    Solves directions in a pool of local processes using concurrent.futures.
+    Starts in a fraction of the time of a DASK cluster, which suits small
+    networks where solves are short. Broadcast objects are passed to the
+    worker processes when the pool is started, so broadcasting restarts the
+    pool.
+
+    Parameters:
+    - n_workers (int): Number of worker processes.
+    - solver_threads (int): Number of threads used by the solver in each
+                            solve. Limits the number of workers.
+    """
+    def __init__(self, n_workers=4, solver_threads=1):
+        self.n_workers = limit_workers(n_workers, solver_threads)
+        self.objects = {}
+        self.counter = itertools.count()
+        self.pool = None
+
+    def _start_pool(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.pool = cf.ProcessPoolExecutor(max_workers=self.n_workers,
+                                           initializer=_set_worker_objects,
+                                           initargs=(self.objects,))
+
+    def broadcast(self, obj):
+        key = next(self.counter)
+        self.objects[key] = obj
+        self._start_pool()
+        return BroadcastRef(key)
+
+    def map(self, fn, iterable, **kwargs):
+        if self.pool is None:
+            self._start_pool()
+        return [self.pool.submit(_call_with_objects, fn, item, kwargs)
+                for item in iterable]
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
+
+
+def limit_workers(n_workers, solver_threads):
+    """ Limit the number of local workers, such that the workers times the
+    solver threads do not exceed the number of CPU cores """
+    max_workers = max(int(os.cpu_count()) // solver_threads, 1)
+    if n_workers > max_workers:
+        print(f'Using {max_workers} workers instead of {n_workers}, '
+              f'as each solve uses {solver_threads} threads')
+        n_workers = max_workers
+    return n_workers
+
+
+def get_solver_threads(case):
+    """ Number of solver threads set in the configuration of the case """
+    try:
+        return int(case.config['solving']['solver'].get('threads', 1))
+    except (AttributeError, KeyError, TypeError):
+        return 1
+
+
+def create_executor(name, n_workers=4, solver_threads=1):
+    """
+    Create an executor by name.
+
+    Parameters:
+    - name (str): 'dask', 'process', 'thread' or 'serial'.
+    - n_workers (int): Number of workers.
+    - solver_threads (int): Number of threads used by the solver in each solve.
+    """
+    if name == 'dask':
+        from .dask_helpers import DaskSession
+        return DaskSession(n_workers=n_workers, solver_threads=solver_threads)
+    elif name == 'process':
+        return ProcessExecutor(n_workers=n_workers,
+                               solver_threads=solver_threads)
+    elif name == 'thread':
+        return ThreadExecutor(n_workers=n_workers)
+    elif name == 'serial':
+        return SerialExecutor()
+    raise ValueError(f'Unknown executor {name}. '
+                     'Use dask, process, thread or serial')
+
+
+@contextmanager
+def use_executor(executor, n_workers, case):
+    """ Use the given executor. If executor is a name (or None for 'dask'),
+    an executor with n_workers workers is created and closed again when
+    leaving the context.
+    """
+    if isinstance(executor, Executor):
+        yield executor
+        return
+
+    executor = create_executor(executor or 'dask',
+                               n_workers=n_workers,
+                               solver_threads=get_solver_threads(case))
+    try:
+        yield executor
+    finally:
+        executor.close()
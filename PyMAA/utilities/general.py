@@ -8,12 +8,27 @@ class DirectionSampler():
     """Class for drawing random directions on the unit hypersphere. 
     Using Chaospy to draw quassi-random samples from a 
     joint normal distribution
+    The Halton sequence is generated by the sampler itself, and continues 
+    from where the previous draw stopped, such that repeated draws do not 
+    regenerate the sequence from the start. The points are mapped to 
+    normal samples with the vectorised inverse normal CDF.
+    dim: Number of dimensions
+    rule: 'halton', 'random' or any sampling rule supported by Chaospy
+    antithetic: Draw directions in pairs of d and -d
     """
-    def __init__(self, dim, rule='halton'):
+    def __init__(self, dim, rule='halton', antithetic=False):
         self.count = 0
         self.dim = dim
-        self.dist = self.create_dist()
         self.rule = rule
+        self.antithetic = antithetic
+        self._dist = None
+        self._pending = np.empty((0, dim))
+
+    @property
+    def dist(self):
+        if self._dist is None:
+            self._dist = self.create_dist()
+        return self._dist
 
     def create_dist(self):
         # Creates a joint distribution with dim normal distributions. 
@@ -23,46 +38,290 @@ class DirectionSampler():
         distribution = chaospy.J(*DD)
         return distribution
 
+    def draw_normal(self, n):
+        """ Draw the next n points of the sequence as normal samples """
+        if self.rule == 'halton':
+            s = halton_normal(self.count, n, self.dim)
+        elif self.rule == 'random':
+            s = np.random.standard_normal((n, self.dim))
+        else:
+            s = self.dist.sample(n+self.count, rule=self.rule)[:, self.count:].T
+        self.count += n
+        return s
+
     def draw_dir(self, n=1):
-        s = self.dist.sample(n+self.count, rule=self.rule)[:, self.count:]
-        norm = np.linalg.norm(s, axis=0)
+        if self.antithetic:
+            # Directions left over from the previous draw come first
+            n_new = n - len(self._pending)
+            s = self.draw_normal(max(-(-n_new//2), 0))
+            s = np.stack([s, -s], axis=1).reshape(-1, self.dim)
+            s = np.concatenate([self._pending, s])
+            s, self._pending = s[:n], s[n:]
+        else:
+            s = self.draw_normal(n)
+        norm = np.linalg.norm(s, axis=1, keepdims=True)
         s_scaled = s/norm
-        self.count += n
-        return s_scaled.T
+        return s_scaled
+
+
+def halton_normal(start, n, dim):
+    """ Points start to start+n of the Halton sequence in dim dimensions,
+    mapped to standard normal samples. The sequence matches the Halton 
+    rule of Chaospy, which skips the first max(primes) points. 
+    """
+    from scipy.special import ndtri
+
+    # The first dim primes
+    primes = []
+    candidate = 2
+    while len(primes) < dim:
+        if all(candidate % p for p in primes):
+            primes.append(candidate)
+        candidate += 1
+
+    u = np.empty((n, dim))
+    for j, base in enumerate(primes):
+        # Radical inverse of the indices in the base
+        idx = np.arange(start, start + n, dtype=np.int64) + primes[-1] + 1
+        out = np.zeros(n)
+        scale = 1.0/base
+        while np.any(idx > 0):
+            out += (idx % base)*scale
+            idx //= base
+            scale /= base
+        u[:, j] = out
+
+    return ndtri(u)
+
+
+def search_direction(direction, case, variables=None):
+    """ Search the case in a single direction. 
+    Used as task function, such that the case can be sent to the 
+    workers once and passed to the tasks as a future.
+    """
+    return case.search_direction(direction, variables)
+
+
+def map_directions(directions, case, executor, case_ref=None):
+    """ Submit a search task for each direction to the executor
+    and return the futures of the tasks.
+    case_ref: The case broadcast to the workers with executor.broadcast.
+              If not given, the case is broadcast for this call only.
+    """
+    if case_ref is None:
+        case_ref = executor.broadcast(case)
+
+    # Only send the variables when a subset of them is searched
+    dim = directions.shape[1]
+    kwargs = {}
+    if dim < len(case.variables):
+        kwargs['variables'] = list(case.variables.keys())[:dim]
+
+    return executor.map(search_direction, 
+                        directions, 
+                        case=case_ref, 
+                        **kwargs)
+
+
+class ResultStore():
+    """ Growable store of the results of solved directions. 
+    Rows are kept in preallocated arrays whose capacity is doubled when 
+    full, so adding results does not copy all previous rows. 
+    Each row holds the vertex, the full dimensional solution, the solver 
+    status, the cost and the direction that produced it.
+    dim: Number of variables searched
+    dim_fullD: Number of variables in the full dimensional solution
+    capacity: Initial number of rows
+    """
+    def __init__(self, dim, dim_fullD=None, capacity=64):
+        if dim_fullD is None:
+            dim_fullD = dim
+        self.n = 0
+        self._directions = np.empty((capacity, dim))
+        self._vertices = np.empty((capacity, dim))
+        self._sol_fullD = np.empty((capacity, dim_fullD))
+        self._stat = np.empty(capacity, dtype=object)
+        self._cost = np.empty(capacity)
+
+    def __len__(self):
+        return self.n
+
+    def _grow(self, n_rows):
+        # Double the capacity until n_rows rows fit
+        capacity = len(self._cost)
+        if n_rows <= capacity:
+            return
+        while capacity < n_rows:
+            capacity *= 2
+        for name in ['_directions', '_vertices', '_sol_fullD', '_stat', '_cost']:
+            old = getattr(self, name)
+            new = np.empty((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:self.n] = old[:self.n]
+            setattr(self, name, new)
+
+    def append(self, direction, vertex, sol_fullD, stat, cost):
+        self._grow(self.n + 1)
+        self._directions[self.n] = direction
+        self._vertices[self.n] = vertex
+        self._sol_fullD[self.n] = sol_fullD
+        self._stat[self.n] = stat
+        self._cost[self.n] = cost
+        self.n += 1
+
+    def add_results(self, directions, res):
+        """ Add the results of solved directions.
+        Directions that were not solved with success are skipped.
+        Returns a mask of the successful results.
+        """
+        solved = []
+        for direction, res_i in zip(directions, res):
+            solved.append(res_i[2] == 'ok')
+            if res_i[2] == 'ok':
+                self.append(direction, 
+                            res_i[0], 
+                            list(res_i[1].values()), 
+                            res_i[2], 
+                            res_i[3])
+            else:
+                print('Direction not solved with sucess')
+
+        return np.array(solved, dtype=bool)
+
+    def delete(self, idx):
+        """ Delete the rows with the given indices """
+        keep = np.ones(self.n, dtype=bool)
+        keep[idx] = False
+        n_keep = int(keep.sum())
+        for name in ['_directions', '_vertices', '_sol_fullD', '_stat', '_cost']:
+            array = getattr(self, name)
+            array[:n_keep] = array[:self.n][keep]
+        self.n = n_keep
+
+    def to_dict(self):
+        """ The stored results as a dict of arrays, for checkpoints """
+        return {'directions': self.directions.copy(),
+                'vertices': self.vertices.copy(),
+                'sol_fullD': self.sol_fullD.copy(),
+                'stat': self.stat.copy(),
+                'cost': self.cost.copy()}
+
+    @classmethod
+    def from_dict(cls, state):
+        """ Create a store holding the results of to_dict() """
+        n, dim = state['vertices'].shape
+        results = cls(dim, state['sol_fullD'].shape[1], capacity=max(n, 64))
+        for direction, vertex, sol_fullD, stat, cost in zip(state['directions'],
+                                                            state['vertices'],
+                                                            state['sol_fullD'],
+                                                            state['stat'],
+                                                            state['cost']):
+            results.append(direction, vertex, sol_fullD, stat, cost)
+        return results
+
+    @property
+    def directions(self):
+        return self._directions[:self.n]
+
+    @property
+    def vertices(self):
+        return self._vertices[:self.n]
+
+    @property
+    def sol_fullD(self):
+        return self._sol_fullD[:self.n]
+
+    @property
+    def stat(self):
+        return self._stat[:self.n]
+
+    @property
+    def cost(self):
+        return self._cost[:self.n]
 
 
 def solve_direcitons(directions,
                      case,
-                     client,
-                     vertices,
-                     sol_fullD,
-                     stat,
-                     cost):
+                     executor,
+                     results,
+                     case_ref=None):
     """ Solve the model for the given directions
     directions: Directions to search in 
     case: test case object
-    client: DASK client
-    vertices: Known vertices
+    executor: Executor running the solves, e.g. a DaskSession
+    results: ResultStore the results are added to
+    case_ref: The case broadcast to the workers with executor.broadcast.
+              If not given, the case is broadcast for this call only.
+    Returns a mask of the directions solved with success.
     """
-    dim = directions.shape[1]
-    variables = list(case.variables.keys())[:dim]
-    params = (directions, [variables for i in range(len(directions))])
-    n_solved = client.map(case.search_direction, *params, pure=False)
+    n_solved = map_directions(directions, case, executor, case_ref)
     
-    res = client.gather(n_solved)
-    for res_i in res:
-        if res_i[2] == 'ok':
-            vertices = np.append(vertices, np.array([res_i[0]]), axis=0)
-            
-            sol_fullD = np.append(sol_fullD, 
-                                  np.array([list(res_i[1].values())]), 
-                                  axis=0)
-            stat = np.append(stat, np.array([res_i[2]]), axis=0)
-            cost = np.append(cost, np.array([res_i[3]]), axis=0)
-        else:
-            print('Direction not solved with sucess')
+    res = executor.gather(n_solved)
     
-    return vertices, sol_fullD, stat, cost
+    return results.add_results(directions, res)
+
+
+class DirectionStream():
+    """ Searches directions with an executor and returns the results 
+    as the solves finish, instead of waiting for a whole batch of 
+    directions. New directions can be submitted while others are running, 
+    which keeps the workers busy when some solves take much longer than 
+    others.
+    case: test case object
+    executor: Executor running the solves, e.g. a DaskSession
+    case_ref: The case broadcast to the workers with executor.broadcast
+    """
+    def __init__(self, case, executor, case_ref=None):
+        self.case = case
+        self.executor = executor
+        if case_ref is None:
+            case_ref = executor.broadcast(case)
+        self.case_ref = case_ref
+        self.pending = {}
+
+    def __len__(self):
+        # Number of directions submitted, but not yet returned
+        return len(self.pending)
+
+    def submit(self, directions):
+        futures = map_directions(directions, 
+                                 self.case, 
+                                 self.executor, 
+                                 self.case_ref)
+        for future, direction in zip(futures, directions):
+            self.pending[future] = direction
+
+    def next_results(self, min_results=None):
+        """ Wait until at least min_results directions have been solved
+        and return all solved directions and their results.
+        If min_results is None, wait for all pending directions.
+        """
+        if min_results is None:
+            min_results = len(self)
+        min_results = min(min_results, len(self))
+
+        directions = []
+        results = []
+        while len(self) > 0:
+            done = [future for future in self.pending if future.done()]
+            if len(done) == 0:
+                if len(results) >= min_results:
+                    break
+                done, _ = self.executor.wait(list(self.pending))
+            for future in done:
+                directions.append(self.pending.pop(future))
+                results.append(future.result())
+
+        if len(directions) == 0:
+            directions = np.empty((0, len(self.case.variables)))
+        return np.array(directions), results
+
+
+def direction_key(direction, decimals=9):
+    """ Hashable key of a direction, equal for directions pointing the 
+    same way """
+    direction = np.asarray(direction, dtype=float)
+    direction = direction/np.linalg.norm(direction)
+    return tuple(np.round(direction, decimals) + 0.0)
 
 
 def check_large_volume(directions, vertices, sample, tol=0):
@@ -71,21 +330,53 @@ def check_large_volume(directions, vertices, sample, tol=0):
     all the hyperplanes defined by
     normals (directions) and points (vertices)
     """
-    dist = []
-    for i in range(len(vertices)):
-        dist.append(directions[i]@(sample-vertices[i]))
-
-    distances = np.array(dist)
-    passing = np.all(distances >= -tol)
+    violated, distances = check_large_volume_batch(directions,
+                                                   vertices,
+                                                   np.atleast_2d(sample),
+                                                   tol)
+    passing = not violated[0]
 
     if not passing:
-        idx = list(np.where(~(distances >= -tol))[0])
+        idx = list(np.where(~(distances[0] >= -tol))[0])
         print(f'violating constraint {idx}')
-        print(distances[idx])
+        print(distances[0][idx])
 
     return passing
 
 
+def check_large_volume_batch(directions, vertices, samples, tol=0,
+                             chunk_size=10000):
+    """
+    Test many points against all half-spaces d_i*(x-v_i) >= 0 defined by 
+    the directions d_i and vertices v_i at once.
+
+    Parameters:
+    - directions (np.array): Searched directions, one per row.
+    - vertices (np.array): Vertex found in each direction.
+    - samples (np.array): Points to test, one per row.
+    - tol (float): Points are accepted up to a distance tol outside a
+                   half-space.
+    - chunk_size (int): Number of points tested per matrix product, 
+                        bounding the memory used.
+
+    Returns:
+    - violated (np.array): True for the points outside the large volume.
+    - distances (np.array): Distance of each point (rows) to each 
+                            half-space (columns). Negative outside.
+    """
+    directions = np.asarray(directions, dtype=float)
+    samples = np.asarray(samples, dtype=float)
+    offsets = np.sum(directions*np.asarray(vertices, dtype=float), axis=1)
+
+    distances = np.empty((len(samples), len(directions)))
+    for start in range(0, len(samples), chunk_size):
+        chunk = samples[start:start+chunk_size]
+        distances[start:start+chunk_size] = chunk@directions.T - offsets
+    violated = np.any(distances < -tol, axis=1)
+
+    return violated, distances
+
+
 def calc_x0(directions, vertices):
     n = vertices.shape[0]
     s = np.random.rand(n-1)
@@ -119,6 +410,102 @@ def check_small_volume(points_nD, p):
 
     return m.Status == 2
 
+
+def check_small_volume_batch(vertices,
+                             samples,
+                             executor=None,
+                             method='auto',
+                             max_hull_dim=8,
+                             chunk_size=500,
+                             tol=1e-6):
+    """
+    Test which samples lie inside the convex hull of the vertices (the 
+    small volume) for all samples at once.
+
+    Parameters:
+    - vertices (np.array): Vertices spanning the small volume.
+    - samples (np.array): Points to test, one per row.
+    - executor (Executor, optional): Executor the LP chunks are solved 
+                                     with. If None, they are solved in 
+                                     this process.
+    - method (str): 'hull' tests the samples against the facet equations 
+                    of the convex hull in one matrix product. 'lp' solves 
+                    one persistent LP per chunk of samples, updating only
+                    the right-hand side for each sample. 'auto' uses the 
+                    hull up to max_hull_dim dimensions, and the LP above,
+                    or when Qhull fails.
+    - max_hull_dim (int): Largest dimension using the hull with 'auto'.
+    - chunk_size (int): Number of samples per LP task.
+    - tol (float): Samples up to a distance tol outside a facet are 
+                   accepted with 'hull'.
+
+    Returns:
+    - accepted (np.array): True for the samples inside the small volume.
+    """
+    from scipy.spatial import ConvexHull
+
+    vertices = np.asarray(vertices, dtype=float)
+    samples = np.asarray(samples, dtype=float)
+
+    if method == 'auto':
+        method = 'hull' if vertices.shape[1] <= max_hull_dim else 'lp'
+
+    if method == 'hull':
+        try:
+            equations = ConvexHull(vertices).equations
+        except Exception as e:
+            print('did not manage to create hull, using LP instead')
+            print(e)
+            method = 'lp'
+        else:
+            distances = samples@equations[:, :-1].T + equations[:, -1]
+            return np.all(distances <= tol, axis=1)
+
+    if method != 'lp':
+        raise ValueError(f'Unknown method {method}. Use auto, hull or lp')
+
+    chunks = [samples[start:start+chunk_size]
+              for start in range(0, len(samples), chunk_size)]
+    if executor is None:
+        accepted = [check_small_volume_lp(chunk, vertices) for chunk in chunks]
+    else:
+        futures = executor.map(check_small_volume_lp, 
+                               chunks, 
+                               vertices=vertices)
+        accepted = executor.gather(futures)
+
+    return np.concatenate(accepted).astype(bool) if accepted else np.empty(0, dtype=bool)
+
+
+def check_small_volume_lp(samples, vertices):
+    """ Test the samples against the small volume with one LP, which is 
+    built once. Only the right-hand side is updated for each sample, 
+    so the solver restarts from the previous basis. 
+    """
+    # Form equality matrix
+    A_eq = np.append(vertices.T, [np.ones(vertices.shape[0])], axis=0)
+    A_eq = np.round(A_eq, 13)
+
+    m = gp.Model('interVol')
+    m.setParam('LogToConsole', 0)
+    x = m.addMVar(shape=vertices.shape[0],
+                  vtype=GRB.CONTINUOUS,
+                  name="x",
+                  lb=0,
+                  ub=1)
+    constr = m.addConstr(A_eq @ x == np.append(samples[0], [1]), name="c")
+    m.setObjective(np.zeros(vertices.shape[0]) @ x, GRB.MINIMIZE)
+
+    accepted = np.zeros(len(samples), dtype=bool)
+    for k, p in enumerate(samples):
+        constr.setAttr('RHS', np.append(p, [1]))
+        m.optimize()
+        accepted[k] = m.Status == GRB.OPTIMAL
+    m.dispose()
+
+    return accepted
+
+
 def calculate_cheb(vertices, directions):
     """
     Calculate the Chebyshev center and radius of a polytope defined by vertices and directions.
@@ -0,0 +1,189 @@
+import numpy as np
+from scipy.spatial import ConvexHull
+
+
+class RebuiltHull:
+    """
+    Convex hull of the vertices found in a search. Each update rebuilds the
+    hull with Qhull from the vertices of the current hull and the new
+    points. Points already found to be interior are left out, but as most
+    vertices of a search are extreme points, an update costs about as much
+    as computing the hull from scratch. Qhull's incremental mode is not
+    used, as it can abort the Python process on some inputs.
+    The facets that were not part of the previous hull are reported by 
+    each update, so new search directions only need to be drawn from them.
+    If Qhull fails, the hull is rebuilt with the fallback options.
+
+    Parameters:
+    - qhull_options (str, optional): Options passed to Qhull.
+    - fallback_options (str, optional): Qhull options used when the hull
+                                        can not be created with qhull_options.
+    """
+    def __init__(self, qhull_options=None, fallback_options='Qx Q12 C-1e-32'):
+        self.qhull_options = qhull_options
+        self.fallback_options = fallback_options
+        self.hull = None
+        self.keys = []
+        self.facet_keys = set()
+
+    @property
+    def equations(self):
+        return self.hull.equations
+
+    @property
+    def volume(self):
+        return self.hull.volume
+
+    def add_points(self, points):
+        """
+        Add new points to the hull.
+
+        Parameters:
+        - points (np.array): Points to add.
+
+        Returns:
+        - changed (np.array): Indices of the facets that were not part of
+                              the previous hull.
+        """
+        points = np.asarray(points, dtype=float)
+        if self.hull is not None:
+            if len(points) == 0:
+                return np.array([], dtype=int)
+            points = np.concatenate([self.hull.points[self.hull.vertices],
+                                     points], axis=0)
+
+        try:
+            self.hull = ConvexHull(points, qhull_options=self.qhull_options)
+        except Exception as e:
+            print('did not manage to update hull')
+            print(e)
+            self.hull = ConvexHull(points,
+                                   qhull_options=self.fallback_options)
+
+        # Facets are identified by their rounded equations, as Qhull
+        # renumbers the facets when the hull is rebuilt
+        self.keys = [tuple(eq) for eq in np.round(self.hull.equations, 9)]
+        changed = np.array([i for i, key in enumerate(self.keys)
+                            if key not in self.facet_keys], dtype=int)
+        self.facet_keys = set(self.keys)
+
+        return changed
+
+
+def outer_support(normals, directions, vertices, executor=None, chunk_size=20):
+    """
+    Support values of the outer bound of the near-optimal space in the
+    given normal directions. The outer bound is the intersection of the
+    half-spaces d_j*x >= d_j*v_j of the searched directions d_j and their
+    vertices v_j. One LP is solved per normal. With an executor, the 
+    normals are split into chunks that are solved in parallel.
+
+    Parameters:
+    - normals (np.array): Directions to evaluate the support in.
+    - directions (np.array): Searched directions.
+    - vertices (np.array): Vertex found in each searched direction.
+    - executor (Executor, optional): Executor solving the chunks of normals.
+    - chunk_size (int): Number of normals solved in each task.
+
+    Returns:
+    - support (np.array): max normal*x over the outer bound for each normal.
+                          np.inf where the outer bound is unbounded.
+    """
+    if executor is None or len(normals) <= chunk_size:
+        return _outer_support_chunk(normals, directions, vertices)
+
+    chunks = [normals[k:k+chunk_size] 
+              for k in range(0, len(normals), chunk_size)]
+    futures = executor.map(_outer_support_chunk, 
+                           chunks, 
+                           directions=directions, 
+                           vertices=vertices)
+    return np.concatenate(executor.gather(futures))
+
+
+def _outer_support_chunk(normals, directions, vertices):
+    from scipy.optimize import linprog
+
+    A_ub = -directions
+    b_ub = -np.sum(directions*vertices, axis=1)
+    support = np.full(len(normals), np.inf)
+    for k, normal in enumerate(normals):
+        res = linprog(-normal,
+                      A_ub=A_ub,
+                      b_ub=b_ub,
+                      bounds=(None, None),
+                      method='highs')
+        if res.status == 0:
+            support[k] = -res.fun
+    return support
+
+
+def support_gaps(normals, directions, vertices, executor=None):
+    """
+    Gap between the outer bound and the inner hull of the vertices in each
+    normal direction, i.e. how far the near-optimal space can at most 
+    extend beyond the hull of the vertices. The largest gap over all 
+    directions is the Hausdorff distance between the inner and outer 
+    approximations. Does not require the hull to be computed.
+
+    Parameters:
+    - normals (np.array): Directions to evaluate the gap in.
+    - directions (np.array): Searched directions.
+    - vertices (np.array): Vertex found in each searched direction.
+    - executor (Executor, optional): Executor solving the LPs of the 
+                                     outer bound in parallel.
+
+    Returns:
+    - gaps (np.array): Gap in each normal direction. np.inf if unbounded.
+    """
+    normals = normals/np.linalg.norm(normals, axis=1, keepdims=True)
+    inner = np.max(normals @ vertices.T, axis=1)
+    outer = outer_support(normals, directions, vertices, executor=executor)
+    return np.maximum(outer - inner, 0)
+
+
+def projected_volume(vertices, pairs):
+    """
+    Sum of the areas of the 2D projections of the hull of the vertices 
+    onto the given pairs of variables. Cheap to compute in any dimension.
+
+    Parameters:
+    - vertices (np.array): Vertices of the hull.
+    - pairs (list): Pairs of variable indices to project onto.
+    """
+    total = 0
+    for pair in pairs:
+        try:
+            total += ConvexHull(vertices[:, list(pair)]).volume
+        except Exception:
+            # Projection is degenerate
+            pass
+    return total
+
+
+def select_directions(candidates, gaps, n_dir, gap_tol=0, dup_tol=1e-3):
+    """
+    Select the candidate directions with the largest gaps, skipping
+    candidates with a gap of at most gap_tol and candidates that are 
+    near-duplicates of an already selected direction.
+
+    Parameters:
+    - candidates (np.array): Candidate directions.
+    - gaps (np.array): Gap of each candidate.
+    - n_dir (int): Maximum number of directions to select.
+    - gap_tol (float): Candidates with gaps up to gap_tol are skipped.
+    - dup_tol (float): Candidates with cosine similarity above 1-dup_tol to
+                       a selected direction are skipped.
+
+    Returns:
+    - selected (np.array): The selected directions, largest gap first.
+    """
+    candidates = candidates/np.linalg.norm(candidates, axis=1, keepdims=True)
+    selected = []
+    for k in np.argsort(-gaps, kind='stable'):
+        if len(selected) >= n_dir or gaps[k] <= gap_tol:
+            break
+        if len(selected) > 0 and np.max(np.array(selected)@candidates[k]) > 1 - dup_tol:
+            continue
+        selected.append(candidates[k])
+    return np.array(selected).reshape(-1, candidates.shape[1])
@@ -53,6 +53,144 @@ def cmap_alpha(cmap_name):
     
     return cmap_alpha
 
+def iter_samples(samples, variables, chunk_size = 100000):
+    '''
+    Iterates over samples in chunks, such that samples streamed by the 
+    samplers can be plotted without loading them all into memory.
+
+    Parameters:
+    - samples: DataFrame or array of samples, a memory-mapped array, the 
+            path of a .npy or .parquet file written by the samplers, or an 
+            iterable of DataFrame or array chunks, e.g. the generator 
+            returned by the samplers when given a chunk_size.
+    - variables (list): Variables to take from the samples. DataFrames and 
+            parquet files are indexed by name, arrays by position.
+    - chunk_size (int, optional): Number of rows per chunk when reading 
+            arrays and files.
+
+    Returns:
+    - chunks (generator): Arrays of samples with one column per variable.
+    '''
+    import numpy as np
+    import pandas as pd
+
+    if isinstance(samples, str):
+        if samples.endswith('.npy'):
+            samples = np.load(samples, mmap_mode = 'r')
+        elif samples.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            batches = pq.ParquetFile(samples).iter_batches(batch_size = chunk_size,
+                                                          columns = [str(v) for v in variables])
+            for batch in batches:
+                yield batch.to_pandas().values
+            return
+        else:
+            raise ValueError(f'Can not read samples from {samples}. '
+                             'Use a .npy or .parquet file')
+
+    if isinstance(samples, (pd.DataFrame, np.ndarray)):
+        samples = [samples]
+        
+    for chunk in samples:
+        if isinstance(chunk, pd.DataFrame):
+            chunk = chunk[variables].values
+        for start in range(0, len(chunk), chunk_size):
+            yield np.asarray(chunk[start:start + chunk_size], dtype = float)
+            
+def sample_statistics(samples, variables, ranges, 
+                      bins = 50, density_bins = 50, pairs = ()):
+    '''
+    Computes histograms and correlations of samples in one pass over the 
+    chunks of samples. As the samples lie within the near-optimal space, 
+    the bins span the ranges of the vertices.
+
+    Parameters:
+    - samples: Samples in any form accepted by iter_samples.
+    - variables (list): Variables of the samples.
+    - ranges (np.array): Lower and upper bound of each variable, shape (2, dim).
+    - bins (int, optional): Number of bins of the histogram of each variable.
+    - density_bins (int, optional): Number of bins of 2D histograms per axis.
+    - pairs (list, optional): Pairs of variable indices (i, j) to compute 
+            2D histograms of.
+
+    Returns:
+    - hists (list): Counts and bin edges of the histogram of each variable.
+    - hists_2d (dict): Counts, x edges and y edges for each pair.
+    - corr (pd.DataFrame): Correlation matrix of the samples.
+    '''
+    import numpy as np
+    import pandas as pd
+
+    dim    = len(variables)
+    counts = [0]*dim
+    counts_2d = {pair: 0 for pair in pairs}
+    n, shift, total, products = 0, None, 0, 0
+    
+    for chunk in iter_samples(samples, variables):
+        if len(chunk) == 0:
+            continue
+        chunk = np.clip(chunk, ranges[0], ranges[1])
+        
+        for k in range(dim):
+            counts[k] = counts[k] + np.histogram(chunk[:,k], bins = bins, 
+                                                 range = ranges[:,k])[0]
+        for (i, j) in pairs:
+            counts_2d[(i, j)] = counts_2d[(i, j)] + np.histogram2d(
+                chunk[:,i], chunk[:,j], bins = density_bins,
+                range = [ranges[:,i], ranges[:,j]])[0]
+            
+        # Sums for the covariance, shifted by the first chunk for accuracy
+        if shift is None:
+            shift = chunk.mean(axis = 0)
+        centered  = chunk - shift
+        n        += len(chunk)
+        total    += centered.sum(axis = 0)
+        products += centered.T @ centered
+        
+    if n == 0:
+        raise ValueError('No samples to plot')
+        
+    hists = [(counts[k], np.histogram_bin_edges([], bins = bins, 
+                                                range = ranges[:,k]))
+             for k in range(dim)]
+    hists_2d = {(i, j): (counts_2d[(i, j)],
+                         np.histogram_bin_edges([], bins = density_bins, range = ranges[:,i]),
+                         np.histogram_bin_edges([], bins = density_bins, range = ranges[:,j]))
+                for (i, j) in pairs}
+    
+    mean = total/n
+    cov  = products/n - np.outer(mean, mean)
+    std  = np.sqrt(np.diag(cov))
+    with np.errstate(invalid = 'ignore', divide = 'ignore'):
+        corr = cov/np.outer(std, std)
+    corr = pd.DataFrame(corr, index = variables, columns = variables)
+    
+    return hists, hists_2d, corr
+
+def histogram_plot(counts, edges, ax, **kwargs):
+    '''
+    Plots precomputed histogram counts as proportions with a KDE line, 
+    like sns.histplot of the samples.
+    '''
+    import pandas as pd
+    import seaborn as sns
+    
+    data = pd.DataFrame({'value': (edges[:-1] + edges[1:])/2, 
+                         'count': counts})
+    return sns.histplot(data = data, x = 'value', weights = 'count', 
+                        bins = list(edges),
+                        stat = 'probability', kde = True,
+                        line_kws = {'linewidth': 3},
+                        ax = ax, **kwargs)
+
+def vertex_ranges(vertices):
+    '''
+    Lower and upper bound of each variable of the vertices, shape (2, dim).
+    '''
+    import numpy as np
+    return np.array([vertices.values.min(axis = 0), 
+                     vertices.values.max(axis = 0)], dtype = float)
+
 def near_optimal_space_matrix(vertices, 
                               samples = None,
                               bins = 50, 
@@ -70,8 +208,11 @@ def near_optimal_space_matrix(vertices,
 
     Parameters:
     - vertices (pd.DataFrame): DataFrame containing vertices of the space.
-    - samples (pd.DataFrame, optional): DataFrame containing samples from the 
-            space. If provided, plot distribution on each projection.
+    - samples (optional): Samples from the space, as a DataFrame or array, 
+            a memory-mapped array, the path of a .npy or .parquet file, or 
+            an iterable of chunks. See iter_samples. If provided, plot 
+            distribution on each projection. Histograms and correlations 
+            are computed chunk by chunk.
     - bins (int, optional): Number of bins for 2D histograms. Default is 50.
     - title (str, optional): Title of the plot.
     - cmap (str, optional): Colormap for correlations. Default is 'Blues'.
@@ -98,11 +239,19 @@ def near_optimal_space_matrix(vertices,
     import matplotlib.colors as mcolors
     import matplotlib.patches as mpatches
     from matplotlib.lines import Line2D
-    import seaborn as sns
     
     variables = list(vertices.columns)
     var_titles = variables
     
+    # Histograms and correlations, computed in one pass over the samples
+    if samples is not None:
+        pairs = [(i, j) for j in range(len(variables)) for i in range(j)]
+        hists, hists_2d, samples_corr = sample_statistics(samples, variables,
+                                                          vertex_ranges(vertices),
+                                                          bins = bins,
+                                                          density_bins = bins,
+                                                          pairs = pairs)
+    
     # -------- Set up plot ----------------------------------------
     set_options()
     
@@ -150,12 +299,6 @@ def near_optimal_space_matrix(vertices,
                 cmap = mcolors.LinearSegmentedColormap.from_list('my_colormap',
                                                                  [red, yellow, green])
                 
-                # Create dataframe from samples
-                samples_df = pd.DataFrame(samples, columns = variables)
-                
-                # Calculate correlation and normalize
-                samples_corr = samples_df.corr()
-                
                 # Calculate normalized correlation, used to color heatmap.
                 samples_temp = samples_corr + abs(samples_corr.min().min())
                 samples_norm = samples_temp / samples_temp.max().max()
@@ -187,13 +330,9 @@ def near_optimal_space_matrix(vertices,
         
         # If samples are provided, calculate and plot histogram
         if samples is not None:
-            sns.histplot(samples_df[variables[j]].values,
-                          bins = bins,
-                          line_kws = {'linewidth':3},
-                          element = 'bars',
-                          stat = 'probability',
-                          kde = True,
-                          ax = ax, label = '_nolegend_',)
+            histogram_plot(*hists[j], ax = ax,
+                           element = 'bars',
+                           label = '_nolegend_',)
             
         # Show optimum if provided
         if opt_solution is not None:
@@ -226,10 +365,8 @@ def near_optimal_space_matrix(vertices,
             # -------- Create 2D histogram ------------------------------------
             
             if samples is not None:
-                # Calculate 2D histogram data from samples for this dimension
-                hist, xedges, yedges = np.histogram2d(samples.values[:,i],
-                                                      samples.values[:,j],
-                                                      bins = bins)
+                # 2D histogram data from samples for this dimension
+                hist, xedges, yedges = hists_2d[(i, j)]
         
                 # Create meshgrid and plot pcolormesh with 2D hist data
                 X, Y = np.meshgrid(xedges, yedges)
@@ -343,7 +480,10 @@ def near_optimal_space_slice(chosen_variables,
     Parameters:
     - chosen_variables (list): List of two variables to be plotted.
     - vertices (pd.DataFrame): DataFrame containing vertices of the space.
-    - samples (pd.DataFrame): DataFrame containing samples from the space.
+    - samples: Samples from the space, as a DataFrame or array, a 
+            memory-mapped array, the path of a .npy or .parquet file, or an 
+            iterable of chunks. See iter_samples. Histograms are computed 
+            chunk by chunk.
     - hist_bins (int, optional): Number of bins for histograms. Default is 50.
     - density_bins (int, optional): Number of bins for sample density. Default is 50.
     - title (str, optional): Title of the plot. 
@@ -363,9 +503,16 @@ def near_optimal_space_slice(chosen_variables,
     import numpy as np
     import matplotlib.patches as mpatches
     from matplotlib.lines import Line2D
-    import seaborn as sns
     
-    all_variables = list(samples.columns)
+    all_variables = list(vertices.columns)
+    chosen = [all_variables.index(v) for v in chosen_variables]
+    
+    # Histograms of the chosen variables, computed in one pass over the samples
+    hists, hists_2d, _ = sample_statistics(samples, all_variables,
+                                           vertex_ranges(vertices),
+                                           bins = hist_bins,
+                                           density_bins = density_bins,
+                                           pairs = [tuple(chosen)])
     
 # - # -------- Set up plot ----------------------------------------
     set_options()
@@ -385,16 +532,11 @@ def near_optimal_space_slice(chosen_variables,
 # - # Histograms - right axis --------------------------
     
     ax = axs[1]
-    for variable in chosen_variables:
-        sns.histplot(samples[variable].values, 
-                     line_kws = {'linewidth': 3},
-                     element  = 'step',
-                     stat     = 'probability',
-                     alpha    = 1/3,
-                     bins     = hist_bins,
-                     kde      = True,
-                     ax       = ax,
-                     label    = variable,)
+    for k, variable in zip(chosen, chosen_variables):
+        histogram_plot(*hists[k], ax = ax,
+                       element  = 'step',
+                       alpha    = 1/3,
+                       label    = variable,)
         
     ax.legend()
     
@@ -402,13 +544,8 @@ def near_optimal_space_slice(chosen_variables,
 
     handles, labels = [], []
     
-    # Set x and y as samples for this dimension
-    x_samples = samples[chosen_variables[0]]
-    y_samples = samples[chosen_variables[1]]
-    
-    # --------  Create 2D histogram --------------------
-    hist, xedges, yedges = np.histogram2d(x_samples, y_samples,
-                                          bins = density_bins)
+    # --------  2D histogram --------------------
+    hist, xedges, yedges = hists_2d[tuple(chosen)]
 
     # Create grid for pcolormesh and plot
     X, Y = np.meshgrid(xedges, yedges)
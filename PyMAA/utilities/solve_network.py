@@ -5,9 +5,11 @@ import logging
 logger = logging.getLogger(__name__)
 import gc
 import os
+import threading
+import time
 import pypsa
 from pypsa.descriptors import nominal_attrs
-from pypsa.linopf import lookup
+from pypsa.linopf import lookup, prepare_lopf
 from pypsa.linopt import (
     define_constraints,
     get_var,
@@ -112,18 +114,53 @@ def objective_constant(n, ext=True, nonext=True):
 
     return constant
 
+def resolve_variable(n, var_i):
+    """
+    Resolve a variable specification [component, carriers, attr, countries]
+    into integer positions, such that its components can be selected by 
+    plain array indexing in every solve of the network.
+
+    Returns a dict with
+    - component, attr, name: The component, attribute and the first carrier 
+                             of the specification.
+    - pos: Positions of the matching components in n.df(component).
+    - var_pos: Positions of the matching components among the extendable 
+               components, which the LP variables of attr are defined for.
+    """
+    df = n.df(var_i[0])
+    # Filter by carrier
+    mask = df.carrier.isin(var_i[1])
+    # filter by country
+    if len(var_i) > 3: 
+        mask = mask & df.country.isin(var_i[3])
+
+    var_pos = get_extendable_i(n, var_i[0]).get_indexer(df.index[mask])
+    return dict(component=var_i[0],
+                attr=var_i[2],
+                name=var_i[1][0],
+                pos=np.flatnonzero(mask.values),
+                var_pos=var_pos[var_pos >= 0])
+
+
+def resolve_variables(n, variables):
+    """ Resolve each variable specification of the dict variables with
+    resolve_variable. Returns a dict with the same keys. """
+    return {name: resolve_variable(n, var_i) 
+            for name, var_i in variables.items()}
+
+
+def get_mga_index(n, options):
+    # Resolved variables of the MGA options, resolved here if the options 
+    # do not carry them
+    if options.get('mga_index') is not None:
+        return options['mga_index']
+    return [resolve_variable(n, var_i) for var_i in options['mga_variables']]
+
+
 def define_mga_objective(n,snapshots,direction,options):
-    mga_variables = options['mga_variables']
     expr_list = []
-    for dir_i,var_i in zip(direction,mga_variables):
-        
-        # Filter by carrier
-        mask = n.df(var_i[0]).carrier.isin(var_i[1])
-        # filter by country
-        if len(var_i)>3: 
-            mask = mask & n.df(var_i[0]).country.isin(var_i[3])
-
-        model_vars = get_var(n,var_i[0],var_i[2])[mask]
+    for dir_i,index_i in zip(direction,get_mga_index(n, options)):
+        model_vars = get_mga_vars(n,index_i)
         tmp_expr = linexpr((dir_i,model_vars)).sum()
         expr_list.append(tmp_expr)
 
@@ -133,17 +170,10 @@ def define_mga_objective(n,snapshots,direction,options):
 def define_point_constraint(n,snapshots,point,options):
     scaling = 1
     
-    mga_variables = options['mga_variables']
-    for p_i,var_i in zip(point,mga_variables):
-        # Filter by carrier
-        mask = n.df(var_i[0]).carrier.isin(var_i[1])
-        # filter by country
-        if len(var_i)>3: 
-            mask = mask & n.df(var_i[0]).country.isin(var_i[3])
-
-        model_vars = get_var(n,var_i[0],var_i[2])[mask]
+    for p_i,index_i in zip(point,get_mga_index(n, options)):
+        model_vars = get_mga_vars(n,index_i)
         expr = linexpr((scaling,model_vars)).sum()
-        define_constraints(n,expr,'==',p_i*scaling,"custom",var_i[1][0])
+        define_constraints(n,expr,'==',p_i*scaling,"custom",index_i['name'])
 
 
 
@@ -231,9 +261,13 @@ def get_objective(n, sns):
 
 def extra_functionality(n, snapshots, mga_options, direction, extra_func):
     
+    build_times = {}
+    start_time = time.time()
+
     # Add user defined constraints that were passed to pypsa_to_case
     if extra_func is not None:
         extra_func(n, snapshots, mga_options)
+    build_times['extra_func'] = time.time() - start_time
     
     
     # Implement MGA constraint 
@@ -246,20 +280,42 @@ def extra_functionality(n, snapshots, mga_options, direction, extra_func):
             # Calculate MGA objective value
             max_obj = (1 + epsilon) * n.objective_optimum
             
-            # Define constraint for near-optimal space
-            define_constraints(n, get_objective(n, n.snapshots), "<=", max_obj, "GlobalConstraint", "Near_optimal")
+            # Build the cost expression once. It is the largest expression
+            # of the model, with a term for every snapshot of every 
+            # component with a marginal cost.
+            start_time = time.time()
+            objective = get_objective(n, n.snapshots)
+            build_times['cost_expression'] = time.time() - start_time
             
-            # Define system cost variable
-            define_variables(n, 0, np.inf , 'system_cost','')
+            # Define system cost variable. Its upper bound defines the 
+            # near-optimal space.
+            start_time = time.time()
+            define_variables(n, -np.inf, max_obj, 'system_cost','')
             
-            # Define system cost adjusted constraint
-            define_constraints(n, get_objective(n, n.snapshots) + linexpr((-1,get_var(n,'system_cost',''))),  '<=' , 0, 'cost_con')
+            # Define system cost constraint
+            define_constraints(n, objective + linexpr((-1,get_var(n,'system_cost',''))),  '==' , 0, 'cost_con')
+            build_times['cost_constraint'] = time.time() - start_time
             
             # Define mga objective via define_mga_objective function
+            start_time = time.time()
             define_mga_objective(n, snapshots, direction, mga_options)
+            build_times['mga_objective'] = time.time() - start_time
             
         else :
+            start_time = time.time()
             define_point_constraint(n,snapshots,direction,mga_options)
+            build_times['point_constraint'] = time.time() - start_time
+
+    logger.info('Model build times: ' + 
+                ', '.join(f'{phase} {t:.2f} s' for phase, t in build_times.items()))
+
+def get_solver_dir():
+    # Use the SLURM scratch directory for solver files if running on SLURM
+    try:
+        tmpdir = '/scratch/' + os.getenv('SLURM_JOB_ID') 
+    except TypeError:
+        tmpdir = 'tmp/'
+    return tmpdir
 
 def solve_network(n, extra_func, config=None, solver_log=None, opts=None, mga_options=None, direction=None, ):
     
@@ -272,10 +328,7 @@ def solve_network(n, extra_func, config=None, solver_log=None, opts=None, mga_op
         solver_log = None
     solver_name = solver_options.pop('name')
 
-    try:
-        tmpdir = '/scratch/' + os.getenv('SLURM_JOB_ID') 
-    except TypeError:
-        tmpdir = 'tmp/'
+    tmpdir = get_solver_dir()
         
 
     def run_lopf(n, allow_warning_status=False):
@@ -325,3 +378,217 @@ def solve_network(n, extra_func, config=None, solver_log=None, opts=None, mga_op
 
 
     return n, status
+
+
+def get_mga_vars(n, index_i):
+    """
+    Return the LP variable references of the components of a variable
+    resolved with resolve_variable.
+    """
+    return get_var(n, index_i['component'], index_i['attr']).iloc[index_i['var_pos']]
+
+
+class PersistentModel:
+    """
+    Near-optimal model that is built once and re-solved for every new 
+    direction by replacing only the objective coefficients.
+    
+    The network, the user defined constraints (extra_func), the near-optimal
+    cost constraint and the system cost variable are written to an LP file 
+    once and read into a persistent Gurobi model. Each call to 
+    solve_direction() sets the MGA objective for the given direction and
+    re-optimizes the model.
+
+    Parameters:
+    - n (pypsa.Network): Network with objective_optimum set.
+    - extra_func (callable): Extra function passed to extra_functionality.
+    - config (dict): Solving section of the configuration.
+    - mga_options (dict): MGA options with mga_slack and mga_variables.
+    - variables (dict): The variables of the case. Values are returned for 
+                        all of these after each solve.
+    - warm_start (bool): Store the simplex basis of each solved direction and 
+                         re-optimize new directions with primal simplex from 
+                         the basis of the nearest solved direction.
+    - max_bases (int): Maximum number of bases kept for warm starts.
+    """
+    def __init__(self, n, extra_func, config, mga_options, variables,
+                 warm_start=False, max_bases=20):
+        import gurobipy as gp
+
+        solver_options = config['solver'].copy()
+        solver_name = solver_options.pop('name')
+        if solver_name != 'gurobi':
+            raise ValueError('Persistent models are only supported with '
+                             f'the gurobi solver, not {solver_name}')
+        if config['options']['formulation'] != 'kirchhoff':
+            raise NotImplementedError('Only the kirchhoff formulation is '
+                                      'supported')
+
+        tmpdir = get_solver_dir()
+        if not os.path.isdir(tmpdir):
+            os.makedirs(tmpdir)
+
+        # Build the near-optimal LP with a zero MGA objective
+        n._multi_invest = 0
+        n.calculate_dependent_values()
+        n.determine_network_topology()
+        direction = np.zeros(len(mga_options['mga_variables']))
+        fdp, problem_fn = prepare_lopf(n, 
+                                       n.snapshots,
+                                       skip_objective=True,
+                                       extra_functionality = lambda n,s: extra_functionality(n,s, mga_options, direction, extra_func),
+                                       solver_dir=tmpdir)
+
+        self.model = gp.read(problem_fn)
+        os.close(fdp)
+        os.remove(problem_fn)
+
+        for key, value in solver_options.items():
+            self.model.setParam(key, value)
+
+        self.warm_start = None
+        if warm_start:
+            self.warm_start = WarmStartStore(max_size=max_bases)
+            # Cold solves must end with a basis to warm start from
+            self.model.setParam('Crossover', -1)
+            self.model_vars = self.model.getVars()
+            self.model_constrs = self.model.getConstrs()
+
+        # Gurobi variables of each case variable and of the system cost
+        # Fixed capacities of non-extendable components are added to the 
+        # values, as they have no LP variables
+        self.variables = {}
+        self.fixed_values = {}
+        for name, index_i in resolve_variables(n, variables).items():
+            self.variables[name] = self._lp_vars(get_mga_vars(n, index_i))
+            df = n.df(index_i['component'])
+            fixed = ~df[index_i['attr'] + '_extendable'].values[index_i['pos']]
+            self.fixed_values[name] = df[index_i['attr']].values[index_i['pos']][fixed].sum()
+        self.cost_var = self._lp_vars(get_var(n, 'system_cost', ''))[0]
+        self.objective_vars = []
+
+    def _lp_vars(self, refs):
+        # Variables are named x<reference> in the LP file written by PyPSA
+        return [self.model.getVarByName(f'x{int(i)}') 
+                for i in np.asarray(refs).ravel()]
+
+    def set_objective(self, direction, variables):
+        """ Replace the objective with the MGA objective of the direction """
+        # Clear coefficients of the previous objective
+        if len(self.objective_vars) > 0:
+            self.model.setAttr('Obj', 
+                               self.objective_vars, 
+                               [0.0]*len(self.objective_vars))
+
+        # Components shared by several variables, e.g. a carrier and a
+        # country subset of it, get the sum of their coefficients
+        coeffs = {}
+        for dir_i, var_name in zip(direction, variables):
+            for var in self.variables[var_name]:
+                _, coeff = coeffs.get(var.index, (var, 0.0))
+                coeffs[var.index] = (var, coeff + float(dir_i))
+        self.objective_vars = [var for var, _ in coeffs.values()]
+        self.model.setAttr('Obj', 
+                           self.objective_vars, 
+                           [coeff for _, coeff in coeffs.values()])
+
+    def solve_direction(self, direction, variables):
+        """
+        Solve the model in the given direction.
+
+        Parameters:
+        - direction (array-like): Search direction.
+        - variables (list): Names of the variables spanning the direction.
+
+        Returns:
+        - status (str): 'ok' if solved to optimality, otherwise 'warning'.
+        - objective (float): Value of the system cost variable.
+        - variable_values (dict): Value of each variable of the case.
+        """
+        from gurobipy import GRB
+
+        self.set_objective(direction, variables)
+
+        if self.warm_start is not None:
+            basis = self.warm_start.nearest(direction)
+            if basis is not None:
+                # The objective change keeps the basis primal feasible
+                self.model.setParam('Method', 0)
+                self.model.setAttr('VBasis', self.model_vars, basis[0].tolist())
+                self.model.setAttr('CBasis', self.model_constrs, basis[1].tolist())
+
+        self.model.optimize()
+
+        if self.model.Status != GRB.OPTIMAL:
+            return 'warning', np.nan, None
+
+        if self.warm_start is not None:
+            self.store_basis(direction)
+
+        variable_values = {name: sum(self.model.getAttr('X', model_vars))
+                                 + self.fixed_values[name]
+                           for name, model_vars in self.variables.items()}
+
+        return 'ok', self.cost_var.X, variable_values
+
+    def store_basis(self, direction):
+        # Save the basis of the current solution for later warm starts
+        from gurobipy import GurobiError
+        try:
+            vbasis = self.model.getAttr('VBasis', self.model_vars)
+            cbasis = self.model.getAttr('CBasis', self.model_constrs)
+        except GurobiError:
+            logger.info('No basis available for warm start')
+            return
+        self.warm_start.add(direction, 
+                            (np.array(vbasis, dtype=np.int8),
+                             np.array(cbasis, dtype=np.int8)))
+
+
+class WarmStartStore:
+    """
+    Stores the bases of solved directions and finds the basis of the
+    solved direction closest to a new direction on the unit sphere.
+    Only the max_size most recent bases are kept.
+    """
+    def __init__(self, max_size=20):
+        self.max_size = max_size
+        self.directions = []
+        self.bases = []
+
+    def __len__(self):
+        return len(self.bases)
+
+    def add(self, direction, basis):
+        direction = np.asarray(direction, dtype=float)
+        self.directions.append(direction/np.linalg.norm(direction))
+        self.bases.append(basis)
+        if len(self.bases) > self.max_size:
+            self.directions.pop(0)
+            self.bases.pop(0)
+
+    def nearest(self, direction):
+        """ Return the basis of the nearest solved direction or None """
+        if len(self.bases) == 0:
+            return None
+        direction = np.asarray(direction, dtype=float)
+        similarity = np.array(self.directions) @ direction
+        return self.bases[int(np.argmax(similarity))]
+
+
+# Worker-local store of persistent models. Models are kept per thread, as
+# concurrent solves of the same Gurobi model would mix up their directions
+_local = threading.local()
+
+def get_persistent_model(key, build):
+    """
+    Return the persistent model stored under key in this worker process
+    and thread. If no model is stored for key, previous models are 
+    discarded and a new model is built by calling build().
+    """
+    if not hasattr(_local, 'models'):
+        _local.models = {}
+    if key not in _local.models:
+        _local.models.clear()
+        _local.models[key] = build()
+    return _local.models[key]
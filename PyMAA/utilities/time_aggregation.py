@@ -0,0 +1,223 @@
+import heapq
+import numpy as np
+import pandas as pd
+
+
+def time_series_profiles(n):
+    """
+    Collect the time-varying data of the network, i.e. the non-empty
+    numeric series of all components, such as p_max_pu of generators and
+    p_set of loads.
+
+    Parameters:
+    - n (pypsa.Network): Network to collect the series of.
+
+    Returns:
+    - profiles (np.array): Snapshots x series array of the collected data,
+                           each column scaled by its largest absolute value.
+    """
+    columns = []
+    for c in n.iterate_components():
+        for attr, df in c.pnl.items():
+            df = df.select_dtypes(include=np.number)
+            if df.empty:
+                continue
+            columns.append(df.reindex(n.snapshots).values.astype(float))
+
+    if len(columns) == 0:
+        raise ValueError('The network has no time-varying data to aggregate')
+
+    profiles = np.concatenate(columns, axis=1)
+    # Constant series carry no information for the aggregation
+    profiles = profiles[:, np.ptp(profiles, axis=0) > 0]
+    scale = np.max(np.abs(profiles), axis=0)
+    return profiles/np.where(scale > 0, scale, 1)
+
+
+def cluster_periods(profiles, n_clusters, period_length=24, method='kmeans',
+                    seed=0):
+    """
+    Cluster the periods of the profiles, e.g. days or weeks, and pick the
+    period closest to the center of each cluster as its representative.
+    Trailing snapshots that do not fill a whole period are left out.
+
+    Parameters:
+    - profiles (np.array): Snapshots x series array of normalized profiles.
+    - n_clusters (int): Number of representative periods.
+    - period_length (int): Number of snapshots in a period, e.g. 24 for days
+                           or 168 for weeks of hourly data.
+    - method (str): 'kmeans' or 'hierarchical' (Ward linkage).
+    - seed (int): Seed of the k-means initialization.
+
+    Returns:
+    - representatives (np.array): Index of each representative period.
+    - counts (np.array): Number of periods represented by each representative.
+    """
+    from scipy.cluster.vq import kmeans2
+    from scipy.cluster.hierarchy import linkage, fcluster
+
+    n_periods = len(profiles)//period_length
+    if n_periods == 0:
+        raise ValueError(f'The network has fewer snapshots than a period of '
+                         f'{period_length} snapshots')
+    n_clusters = min(max(int(n_clusters), 1), n_periods)
+    periods = profiles[:n_periods*period_length].reshape(n_periods, -1)
+
+    if method == 'kmeans':
+        _, labels = kmeans2(periods, n_clusters, minit='++', seed=seed)
+    elif method == 'hierarchical':
+        labels = fcluster(linkage(periods, method='ward'),
+                          n_clusters, criterion='maxclust') - 1
+    else:
+        raise ValueError(f'Unknown clustering method {method}. '
+                         'Use kmeans or hierarchical')
+
+    representatives = []
+    counts = []
+    for label in np.unique(labels):
+        members = np.flatnonzero(labels == label)
+        center = periods[members].mean(axis=0)
+        distances = np.sum((periods[members] - center)**2, axis=1)
+        representatives.append(members[np.argmin(distances)])
+        counts.append(len(members))
+
+    order = np.argsort(representatives)
+    return np.array(representatives)[order], np.array(counts)[order]
+
+
+def segment_snapshots(profiles, n_segments, weights=None):
+    """
+    Split the snapshots into contiguous segments of variable length, by
+    repeatedly merging the two adjacent segments whose merge increases the
+    within-segment variance of the profiles the least.
+
+    Parameters:
+    - profiles (np.array): Snapshots x series array of normalized profiles.
+    - n_segments (int): Number of segments.
+    - weights (np.array, optional): Weight of each snapshot. default 1.
+
+    Returns:
+    - labels (np.array): Segment of each snapshot, numbered in time order.
+    """
+    n_snapshots = len(profiles)
+    n_segments = min(max(int(n_segments), 1), n_snapshots)
+    if weights is None:
+        weights = np.ones(n_snapshots)
+
+    # Segments are kept as a linked list of weighted means
+    size = np.asarray(weights, dtype=float).copy()
+    mean = np.asarray(profiles, dtype=float).copy()
+    prev = np.arange(-1, n_snapshots - 1)
+    following = np.arange(1, n_snapshots + 1)
+    alive = np.ones(n_snapshots, dtype=bool)
+    version = np.zeros(n_snapshots, dtype=int)
+
+    def merge_cost(a, b):
+        diff = mean[a] - mean[b]
+        return size[a]*size[b]/(size[a] + size[b])*np.dot(diff, diff)
+
+    heap = [(merge_cost(a, a + 1), a, 0, 0) for a in range(n_snapshots - 1)]
+    heapq.heapify(heap)
+
+    n_alive = n_snapshots
+    while n_alive > n_segments:
+        _, a, version_a, version_b = heapq.heappop(heap)
+        b = following[a]
+        # Skip merges of segments that have changed since they were queued
+        if (not alive[a] or b >= n_snapshots or version[a] != version_a
+                or version[b] != version_b):
+            continue
+
+        total = size[a] + size[b]
+        mean[a] = (size[a]*mean[a] + size[b]*mean[b])/total
+        size[a] = total
+        alive[b] = False
+        following[a] = following[b]
+        if following[b] < n_snapshots:
+            prev[following[b]] = a
+        version[a] += 1
+        n_alive -= 1
+
+        if prev[a] >= 0:
+            heapq.heappush(heap, (merge_cost(prev[a], a), prev[a],
+                                  version[prev[a]], version[a]))
+        if following[a] < n_snapshots:
+            heapq.heappush(heap, (merge_cost(a, following[a]), a,
+                                  version[a], version[following[a]]))
+
+    return np.cumsum(alive) - 1
+
+
+def aggregate_network(n, n_snapshots, method='kmeans', period_length=24,
+                      seed=0):
+    """
+    Reduce the snapshots of the network in place, while keeping the
+    variation over the whole time horizon.
+    With 'kmeans' or 'hierarchical', the network keeps n_snapshots//period_length
+    representative periods, each weighted by the number of periods in its
+    cluster. Note that storage is then operated across consecutive
+    representative periods as if they were adjacent in time.
+    With 'segmentation', the snapshots are merged into n_snapshots contiguous
+    segments of variable length, weighted by the number of snapshots they
+    contain, and the time series are averaged over each segment.
+    The total snapshot weighting of the network is preserved.
+
+    Parameters:
+    - n (pypsa.Network): Network to aggregate.
+    - n_snapshots (int): Number of snapshots of the aggregated network.
+    - method (str): 'kmeans', 'hierarchical' or 'segmentation'.
+    - period_length (int): Number of snapshots in a representative period.
+    - seed (int): Seed of the k-means initialization.
+    """
+    profiles = time_series_profiles(n)
+    weightings = n.snapshot_weightings.copy()
+
+    if method in ['kmeans', 'hierarchical']:
+        representatives, counts = cluster_periods(profiles,
+                                                  n_snapshots//period_length,
+                                                  period_length=period_length,
+                                                  method=method,
+                                                  seed=seed)
+        positions = (representatives[:, None]*period_length
+                     + np.arange(period_length)).ravel()
+        snapshots = n.snapshots[positions]
+        n.set_snapshots(snapshots)
+        aggregated = weightings.loc[snapshots].multiply(
+            np.repeat(counts, period_length), axis=0)
+        # Snapshots left out of the periods are spread over all periods
+        n.snapshot_weightings = aggregated*weightings.sum()/aggregated.sum()
+        print(f'Aggregated {len(weightings)} snapshots into '
+              f'{len(representatives)} periods of {period_length} snapshots')
+
+    elif method == 'segmentation':
+        labels = segment_snapshots(profiles, n_snapshots,
+                                   weights=weightings.objective.values)
+        starts = np.flatnonzero(np.diff(labels, prepend=-1))
+        snapshots = n.snapshots[starts]
+
+        # Average the series over each segment, weighted by the snapshots
+        weights = pd.Series(weightings.objective.values, index=n.snapshots)
+        averages = {}
+        for c in n.iterate_components():
+            for attr, df in c.pnl.items():
+                if df.empty:
+                    continue
+                df = df.reindex(n.snapshots)
+                numeric = df.select_dtypes(include=np.number).columns
+                average = df.iloc[starts].copy()
+                weighted = df[numeric].multiply(weights, axis=0)
+                average[numeric] = (weighted.groupby(labels).sum().values
+                                    / weights.groupby(labels).sum().values[:, None])
+                averages[(c.name, attr)] = average
+
+        n.set_snapshots(snapshots)
+        for (component, attr), average in averages.items():
+            n.pnl(component)[attr] = average.set_axis(snapshots, axis=0)
+        n.snapshot_weightings = weightings.groupby(labels).sum().set_axis(snapshots,
+                                                                          axis=0)
+        print(f'Aggregated {len(weightings)} snapshots into '
+              f'{len(snapshots)} segments')
+
+    else:
+        raise ValueError(f'Unknown aggregation {method}. '
+                         'Use kmeans, hierarchical or segmentation')
@@ -72,7 +72,10 @@ if __name__ == '__main__':
     samples = PyMAA.sampler.har_sample(1_000_000, 
                                        x0 = np.zeros(len(vertices.columns)), 
                                        directions = directions, 
-                                       vertices = vertices)
+                                       vertices = vertices,
+                                       n_chains = 100,
+                                       burn_in = 100,
+                                       seed = 0)
 
     
 